@@ -8,16 +8,28 @@ import collections
 import json
 import pickle
 import math
+import hashlib
+import shutil
+import multiprocessing
 import datetime
+import inspect
 from tqdm import tqdm
 from recordclass import recordclass
 import copy
 
 import torch
-import torch.autograd as autograd
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
 torch.backends.cudnn.deterministic = True
 
 
@@ -31,53 +43,137 @@ def custom_print(*msg):
             logger.write(str(msg[i]))
 
 
+def read_word_embedding(embed_file, vocab):
+    """
+    Returns the words and the float32 vectors of the lines of embed_file whose word is in the vocabulary,
+    without parsing the vectors of the other lines
+    """
+    embed_words = list()
+    embed_rows = list()
+    with open(embed_file, "r") as f:
+        for line in f:
+            parts = line.split(None, 1)
+            if len(parts) == 0:
+                continue
+            word = parts[0]
+            if word in vocab and vocab[word] >= word_density:
+                parts = line.split()
+                if len(parts) != word_embed_dim + 1:
+                    continue
+                embed_words.append(word)
+                embed_rows.append(parts[1:])
+    return embed_words, np.array(embed_rows, dtype=np.float32).reshape(-1, word_embed_dim)
+
+
+def is_writable_dir(dir_path):
+    """
+    Creates dir_path when missing and returns whether files can be written into it, so that the caches are
+    skipped on a read-only or shared cache_root
+    """
+    try:
+        if not os.path.exists(dir_path):
+            os.makedirs(dir_path)
+    except OSError:
+        pass
+    if os.path.isdir(dir_path) and os.access(dir_path, os.W_OK):
+        return True
+    custom_print('cache folder is not writable, not caching:', dir_path)
+    return False
+
+
+def get_embed_cache_path(embed_file):
+    hasher = hashlib.sha1()
+    get_file_hash(embed_file, hasher)
+    hasher.update(str(word_embed_dim).encode('utf-8'))
+    file_name = os.path.splitext(os.path.basename(embed_file))[0]
+    return os.path.join(data_cache_dir, file_name + '-' + hasher.hexdigest()[:16])
+
+
+def compile_word_embedding(embed_file, cache_path, chunk_size=100000):
+    """
+    Converts all the vectors of embed_file into a float32 matrix .npy file with its word list in words.pkl.
+    Lines other than a word and word_embed_dim values, such as those of multi-token words, are skipped.
+    """
+    embed_words = list()
+    embed_chunks = list()
+    embed_rows = list()
+    with open(embed_file, "r") as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) != word_embed_dim + 1:
+                continue
+            embed_words.append(parts[0])
+            embed_rows.append(parts[1:])
+            if len(embed_rows) == chunk_size:
+                embed_chunks.append(np.array(embed_rows, dtype=np.float32))
+                embed_rows = list()
+    embed_chunks.append(np.array(embed_rows, dtype=np.float32).reshape(-1, word_embed_dim))
+
+    tmp_path = cache_path + '.tmp' + str(os.getpid())
+    os.makedirs(tmp_path)
+    np.save(os.path.join(tmp_path, 'matrix.npy'), np.concatenate(embed_chunks))
+    with open(os.path.join(tmp_path, 'words.pkl'), 'wb') as f:
+        pickle.dump(embed_words, f, protocol=pickle.HIGHEST_PROTOCOL)
+    try:
+        os.rename(tmp_path, cache_path)
+    except OSError:
+        # another run compiled the same embeddings first
+        shutil.rmtree(tmp_path)
+
+
+def load_compiled_word_embedding(cache_path, vocab):
+    with open(os.path.join(cache_path, 'words.pkl'), 'rb') as f:
+        all_words = pickle.load(f)
+    all_vectors = np.load(os.path.join(cache_path, 'matrix.npy'), mmap_mode='r')
+    rows = [i for i, word in enumerate(all_words) if word in vocab and vocab[word] >= word_density]
+    return [all_words[i] for i in rows], np.array(all_vectors[rows], dtype=np.float32)
+
+
 def load_word_embedding(embed_file, vocab):
     custom_print('vocab length:', len(vocab))
     # custom_print('entity vocab length', len(entity_vocab))
     embed_vocab = OrderedDict()
-    embed_matrix = list()
     embed_vocab['<PAD>'] = 0
-    embed_matrix.append(np.zeros(word_embed_dim, dtype=np.float32))
     embed_vocab['<UNK>'] = 1
-    embed_matrix.append(np.random.uniform(-0.25, 0.25, word_embed_dim))
+    unk_vector = np.random.uniform(-0.25, 0.25, word_embed_dim)
     word_idx = 2
 
-    with open(embed_file, "r") as f:
-        for line in f:
-            parts = line.split()
-            if len(parts) < word_embed_dim + 1:
-                continue
-            word = parts[0]
-            if word in vocab and vocab[word] >= word_density:
-                    vec = [np.float32(val) for val in parts[1:]]
-                    embed_matrix.append(vec)
-                    embed_vocab[word] = word_idx
-                    word_idx += 1
+    cache_path = get_embed_cache_path(embed_file) if use_embed_cache else None
+    if cache_path is not None and not os.path.exists(cache_path) and is_writable_dir(data_cache_dir):
+        compile_word_embedding(embed_file, cache_path)
+    if cache_path is not None and os.path.exists(cache_path):
+        embed_words, embed_vectors = load_compiled_word_embedding(cache_path, vocab)
+    else:
+        embed_words, embed_vectors = read_word_embedding(embed_file, vocab)
+    for word in embed_words:
+        embed_vocab[word] = word_idx
+        word_idx += 1
 
     custom_print('embed vocab length:', len(embed_vocab))
 
-    for word in vocab:
-        if word not in embed_vocab and vocab[word] >= word_density:
-            # custom_print(word)
-            embed_matrix.append(np.random.uniform(-0.25, 0.25, word_embed_dim))
-            embed_vocab[word] = word_idx
-            word_idx += 1
+    missing_words = [word for word in vocab if word not in embed_vocab and vocab[word] >= word_density]
+    for word in missing_words:
+        # custom_print(word)
+        embed_vocab[word] = word_idx
+        word_idx += 1
+    missing_vectors = np.random.uniform(-0.25, 0.25, (len(missing_words), word_embed_dim))
 
     custom_print('embed vocab length:', len(embed_vocab))
-    return embed_vocab, np.array(embed_matrix, dtype=np.float32)
+    embed_matrix = np.concatenate((np.zeros((1, word_embed_dim), dtype=np.float32),
+                                   unk_vector[np.newaxis, :].astype(np.float32),
+                                   embed_vectors,
+                                   missing_vectors.astype(np.float32)))
+    return embed_vocab, embed_matrix
 
 
 def build_vocab(train, dev, test, vocab_file, embedding_file):
+    # words are counted once per relation mention and kept in the order of their first occurrence
+    word_ids = np.concatenate([d.Words for d in train + dev + test])
+    word_counts = np.bincount(word_ids, minlength=len(data_words))
+    unique_ids, first_pos = np.unique(word_ids, return_index=True)
     vocab = OrderedDict()
-
-    for d in train + dev + test:
-        for word in d.Text.split():
-            word = word.strip()
-            if len(word) > 0:
-                if word not in vocab:
-                    vocab[word] = 1
-                else:
-                    vocab[word] += 1
+    for word_id in unique_ids[np.argsort(first_pos)].tolist():
+        vocab[data_words[word_id]] = int(word_counts[word_id])
 
     embed_vocab, embed_matrix = load_word_embedding(embedding_file, vocab)
     output = open(vocab_file, 'wb')
@@ -92,239 +188,608 @@ def load_vocab(vocab_file):
     return embed_vocab
 
 
-def get_sample(uid, Id, sent, arg1, arg2, arg1_start, arg1_end, arg2_start, arg2_end, rel_name):
-    sent = sent.strip()
-    words = sent.split()
-    norm_words = words
-    norm_words.append('<PAD>')
-    norm_words.append('<PAD>')
-    norm_words.append('<PAD>')
-    norm_words.append('<PAD>')
-    norm_words.append('<PAD>')
-
-    arg1_mask = list()
-    arg2_mask = list()
-    piece1_mask = list()
-    piece2_mask = list()
-    piece3_mask = list()
-    words_mask = list()
-
-    for i in range(0, len(norm_words)):
-        arg1_mask.append(0)
-        arg2_mask.append(0)
-        piece1_mask.append(0)
-        piece2_mask.append(0)
-        piece3_mask.append(0)
-        words_mask.append(0)
-
-    for i in range(0, len(words)):
-        words_mask[i] = 1
-    first_cut_idx = arg1_end
-    second_cut_idx = arg2_end
-    if arg2_start < arg1_start:
-        first_cut_idx, second_cut_idx = second_cut_idx, first_cut_idx
-
-    for i in range(0, first_cut_idx + 1):
-        piece1_mask[i] = 1
-    for i in range(first_cut_idx, second_cut_idx+1):
-        piece2_mask[i] = 1
-    for i in range(second_cut_idx, len(words)):
-        piece3_mask[i] = 1
-
-    entity_indicator = list()
-    for ind in range(0, len(words)):
-        entity_indicator.append(1)
-    for ind in range(arg1_start, arg1_end+1):
-        entity_indicator[ind] = 2
-    for ind in range(arg2_start, arg2_end+1):
-        entity_indicator[ind] = 3
-
-    arg1_head_dist_lst = list()
-    arg2_head_dist_lst = list()
-    for ind in range(0, len(norm_words)):
-        dist = arg1_start - ind
-        if dist >= 0:
-            dist += 1
-            dist = min(dist, max_word_arg_head_dist)
-        else:
-            dist *= -1
-            dist = min(dist, max_word_arg_head_dist)
-            dist += max_word_arg_head_dist
-        arg1_head_dist_lst.append(dist)
-        dist = arg2_start - ind
-        if dist >= 0:
-            dist += 1
-            dist = min(dist, max_word_arg_head_dist)
+def get_features(words_len, arg1_start, arg1_end, arg2_start, arg2_end, max_len, ctx_features=True):
+    """
+    Returns the word and piece masks and the argument head distances of a batch of relation mentions as
+    [N, max_len] numpy arrays padded with zeros, and with ctx_features the entity indicators and argument
+    context masks as well, which the models do not read
+    """
+    pos = np.arange(max_len, dtype=np.int32)[np.newaxis, :]
+    words_len = np.asarray(words_len, dtype=np.int32)[:, np.newaxis]
+    arg1_start = np.asarray(arg1_start, dtype=np.int32)[:, np.newaxis]
+    arg1_end = np.asarray(arg1_end, dtype=np.int32)[:, np.newaxis]
+    arg2_start = np.asarray(arg2_start, dtype=np.int32)[:, np.newaxis]
+    arg2_end = np.asarray(arg2_end, dtype=np.int32)[:, np.newaxis]
+
+    words_mask = pos < words_len
+
+    is_swapped = arg2_start < arg1_start
+    first_cut_idx = np.where(is_swapped, arg2_end, arg1_end)
+    second_cut_idx = np.where(is_swapped, arg1_end, arg2_end)
+    piece1_mask = words_mask & (pos <= first_cut_idx)
+    piece2_mask = words_mask & (pos >= first_cut_idx) & (pos <= second_cut_idx)
+    piece3_mask = words_mask & (pos >= second_cut_idx)
+
+    arg1_span = (pos >= arg1_start) & (pos <= arg1_end)
+    arg2_span = (pos >= arg2_start) & (pos <= arg2_end)
+
+    def get_head_dist(arg_start, arg_span):
+        dist = arg_start - pos
+        dist = np.where(dist >= 0, np.minimum(dist + 1, max_word_arg_head_dist),
+                        np.minimum(-dist, max_word_arg_head_dist) + max_word_arg_head_dist)
+        dist[arg_span] = 1
+        dist[~words_mask] = 0
+        return dist
+
+    arg1_head_dist = get_head_dist(arg1_start, arg1_span)
+    arg2_head_dist = get_head_dist(arg2_start, arg2_span)
+
+    features = {'wordsMask': words_mask.astype(np.int32),
+                'arg1LinDist': arg1_head_dist.astype(np.int32),
+                'arg2LinDist': arg2_head_dist.astype(np.int32),
+                'piece1Mask': piece1_mask.astype(np.int32),
+                'piece2Mask': piece2_mask.astype(np.int32),
+                'piece3Mask': piece3_mask.astype(np.int32)}
+    if not ctx_features:
+        return features
+
+    entity_indicator = words_mask.astype(np.int32)
+    entity_indicator[words_mask & arg1_span] = 2
+    entity_indicator[words_mask & arg2_span] = 3
+
+    def get_ctx_mask(arg_start, arg_end):
+        ctx_start = np.maximum(0, arg_start - ctx_len)
+        ctx_end = np.minimum(words_len - 1, arg_end + ctx_len)
+        return (pos >= ctx_start) & (pos <= ctx_end)
+
+    features['entIndicator'] = entity_indicator
+    features['arg1Mask'] = get_ctx_mask(arg1_start, arg1_end).astype(np.int32)
+    features['arg2Mask'] = get_ctx_mask(arg2_start, arg2_end).astype(np.int32)
+    return features
+
+
+def get_word_ids(words):
+    """
+    Returns the ids of words in the word table shared by all the loaded datasets, adding the new words
+    """
+    word_ids = []
+    for word in words:
+        if word not in data_word_idx:
+            data_word_idx[word] = len(data_words)
+            data_words.append(word)
+        word_ids.append(data_word_idx[word])
+    return word_ids
+
+
+def iter_mentions(lines, is_training_data=False, chunk_size=10000, stats=None):
+    """
+    Yields the relation mentions of an iterable of JSON lines in chunks of at most chunk_size lines.
+    The line, unknown relation and overlong sentence counts are kept in stats.
+    """
+    if stats is None:
+        stats = dict()
+    stats.update({'lines': 0, 'cnt': 0, 'out_of_len': 0})
+    mentions = []
+    uid = 1
+    chunk_lines = 0
+    for line in lines:
+        stats['lines'] += 1
+        chunk_lines += 1
+        data = json_loads(line.strip())
+        sent = data['sentText']
+        if is_training_data and len(sent.split()) > max_sent_len:
+            stats['out_of_len'] += 1
         else:
-            dist *= -1
-            dist = min(dist, max_word_arg_head_dist)
-            dist += max_word_arg_head_dist
-        arg2_head_dist_lst.append(dist)
+            sent = sent.strip()
+            words = sent.split()
+            for rel_mention in data['relationMentions']:
+                arg1 = rel_mention['arg1Text']
+                arg2 = rel_mention['arg2Text']
+                rel_name = rel_mention['relationName']
+
+                if is_training_data and rel_name not in relation_cls_label_map:
+                    continue
+                if rel_name not in relation_cls_label_map:
+                    stats['cnt'] += 1
+
+                mentions.append((uid, data['sentId'], sent, words, arg1, arg2,
+                                 int(rel_mention['arg1StartIndex']), int(rel_mention['arg1EndIndex']),
+                                 int(rel_mention['arg2StartIndex']), int(rel_mention['arg2EndIndex']),
+                                 rel_name))
+                uid += 1
+        if chunk_lines == chunk_size:
+            if len(mentions) > 0:
+                yield mentions
+            mentions = []
+            chunk_lines = 0
+    if len(mentions) > 0:
+        yield mentions
+
+
+def get_mentions(lines, is_training_data=False):
+    mentions = []
+    stats = dict()
+    for chunk in iter_mentions(lines, is_training_data, data_chunk_size, stats):
+        mentions += chunk
+    return mentions, stats
+
+
+def print_data_stats(stats, is_training_data=False):
+    custom_print(stats['lines'])
+    custom_print(stats['cnt'])
+    if is_training_data:
+        custom_print(stats['out_of_len'])
 
-    for ind in range(arg1_start, arg1_end + 1):
-        arg1_head_dist_lst[ind] = 1
-    for ind in range(arg2_start, arg2_end + 1):
-        arg2_head_dist_lst[ind] = 1
 
-    arg1_ctx_start = max(0, arg1_start - ctx_len)
-    arg1_ctx_end = min(len(words)-1, arg1_end + ctx_len)
+compiled_arrays = ['tokens', 'sent_offsets', 'mention_sent', 'spans', 'labels']
 
-    arg2_ctx_start = max(0, arg2_start - ctx_len)
-    arg2_ctx_end = min(len(words) - 1, arg2_end + ctx_len)
 
-    for i in range(arg1_ctx_start, arg1_ctx_end + 1):
-        arg1_mask[i] = 1
-    for i in range(arg2_ctx_start, arg2_ctx_end + 1):
-        arg2_mask[i] = 1
+def compile_mentions(mentions, stats=None):
+    """
+    Compiles relation mentions into flat int32 token ids of a dataset word table with sentence offsets,
+    argument spans and label ids. Label ids past the relation map index the unknown relation names.
+    """
+    word_idx = dict()
+    word_table = []
+    rel_table = list(relation_cls_label_map)
+    rel_idx = dict((rel_name, idx) for idx, rel_name in enumerate(rel_table))
+    tokens = []
+    sent_offsets = [0]
+    sent_ids = []
+    sent_texts = []
+    mention_sent = []
+    spans = []
+    labels = []
+    arg1_list = []
+    arg2_list = []
+    last_words = None
+    for m in mentions:
+        Id, sent, words = m[1:4]
+        if words is not last_words:
+            for word in words:
+                if word not in word_idx:
+                    word_idx[word] = len(word_table)
+                    word_table.append(word)
+                tokens.append(word_idx[word])
+            sent_offsets.append(len(tokens))
+            sent_ids.append(Id)
+            sent_texts.append(sent)
+            last_words = words
+        rel_name = m[10]
+        if rel_name not in rel_idx:
+            rel_idx[rel_name] = len(rel_table)
+            rel_table.append(rel_name)
+        mention_sent.append(len(sent_ids) - 1)
+        spans.append(m[6:10])
+        labels.append(rel_idx[rel_name])
+        arg1_list.append(m[4])
+        arg2_list.append(m[5])
+
+    return {'tokens': np.array(tokens, dtype=np.int32),
+            'sent_offsets': np.array(sent_offsets, dtype=np.int64),
+            'mention_sent': np.array(mention_sent, dtype=np.int32),
+            'spans': np.array(spans, dtype=np.int32).reshape(-1, 4),
+            'labels': np.array(labels, dtype=np.int32),
+            'word_table': word_table, 'rel_table': rel_table, 'sent_ids': sent_ids, 'sent_texts': sent_texts,
+            'arg1': arg1_list, 'arg2': arg2_list, 'stats': stats}
+
+
+def merge_compiled(parts, stats):
+    """
+    Concatenates compiled datasets in order, remapping their word and relation tables into one
+    """
+    word_idx = dict()
+    word_table = []
+    rel_table = list(relation_cls_label_map)
+    rel_idx = dict((rel_name, idx) for idx, rel_name in enumerate(rel_table))
+
+    def get_remap(table, table_idx, names):
+        remap = []
+        for name in names:
+            if name not in table_idx:
+                table_idx[name] = len(table)
+                table.append(name)
+            remap.append(table_idx[name])
+        return np.array(remap, dtype=np.int32)
+
+    merged = {'tokens': [], 'sent_offsets': [np.zeros(1, dtype=np.int64)], 'mention_sent': [], 'spans': [],
+              'labels': [], 'sent_ids': [], 'sent_texts': [], 'arg1': [], 'arg2': []}
+    num_tokens = 0
+    num_sents = 0
+    for part in parts:
+        word_remap = get_remap(word_table, word_idx, part['word_table'])
+        rel_remap = get_remap(rel_table, rel_idx, part['rel_table'])
+        merged['tokens'].append(word_remap[part['tokens']])
+        merged['sent_offsets'].append(part['sent_offsets'][1:] + num_tokens)
+        merged['mention_sent'].append(part['mention_sent'] + num_sents)
+        merged['spans'].append(part['spans'])
+        merged['labels'].append(rel_remap[part['labels']])
+        for key in ['sent_ids', 'sent_texts', 'arg1', 'arg2']:
+            merged[key] += part[key]
+        num_tokens += len(part['tokens'])
+        num_sents += len(part['sent_ids'])
+
+    merged['tokens'] = np.concatenate(merged['tokens'] + [np.zeros(0, dtype=np.int32)]).astype(np.int32)
+    merged['sent_offsets'] = np.concatenate(merged['sent_offsets']).astype(np.int64)
+    merged['mention_sent'] = np.concatenate(merged['mention_sent'] + [np.zeros(0, dtype=np.int32)]).astype(np.int32)
+    merged['spans'] = np.concatenate(merged['spans'] + [np.zeros((0, 4), dtype=np.int32)]).astype(np.int32)
+    merged['labels'] = np.concatenate(merged['labels'] + [np.zeros(0, dtype=np.int32)]).astype(np.int32)
+    merged['word_table'] = word_table
+    merged['rel_table'] = rel_table
+    merged['stats'] = stats
+    return merged
+
+
+def get_compiled_samples(compiled, first_uid=1, shared_words=True):
+    """
+    Returns the samples of a compiled dataset. The token ids of every sentence are a view of one flat array
+    of data word table ids shared by all the mentions of the sentence. Without shared_words they stay ids of
+    the compiled word table, which is then not added to the data word table.
+    """
+    tokens = compiled['tokens']
+    if shared_words:
+        word_ids = np.array(get_word_ids(compiled['word_table']), dtype=np.int32)
+        if not np.array_equal(word_ids, np.arange(len(word_ids))):
+            tokens = word_ids[tokens]
+    offsets = compiled['sent_offsets'].tolist()
+    sent_words = [tokens[offsets[i]:offsets[i + 1]] for i in range(0, len(offsets) - 1)]
+    sent_ids = compiled['sent_ids']
+    sent_texts = compiled['sent_texts']
+    arg1_list = compiled['arg1']
+    arg2_list = compiled['arg2']
+    rel_table = compiled['rel_table']
+    class_count = len(relation_cls_label_map)
+
+    samples = []
+    mention_sent = compiled['mention_sent'].tolist()
+    spans = compiled['spans'].tolist()
+    labels = compiled['labels'].tolist()
+    for i in range(0, len(mention_sent)):
+        sent_idx = mention_sent[i]
+        span = spans[i]
+        label = labels[i]
+        words = sent_words[sent_idx]
+        sample = QASample(UID=first_uid + i, Id=sent_ids[sent_idx], Len=len(words) + 5, Text=sent_texts[sent_idx],
+                          Arg1=arg1_list[i], Arg2=arg2_list[i], Words=words,
+                          Arg1Start=span[0], Arg1End=span[1], Arg2Start=span[2], Arg2End=span[3],
+                          Label=label if label < class_count else -1, RelationName=rel_table[label],
+                          WordIds=None, Arg1Id=None, Arg2Id=None)
+        samples.append(sample)
+    return samples
+
+
+def get_samples(mentions):
+    """
+    Builds the samples of a list of (uid, Id, sent, words, arg1, arg2, arg1_start, arg1_end, arg2_start,
+    arg2_end, rel_name) relation mentions with consecutive uids
+    """
+    if len(mentions) == 0:
+        return []
+    return get_compiled_samples(compile_mentions(mentions), mentions[0][0])
+
 
-    sample = QASample(UID=uid, Id=Id, Len=len(norm_words), Text=sent, Arg1=arg1, Arg2=arg2,
-                      Words=norm_words, WordsMask=words_mask, WordsEntIndicator=entity_indicator,
-                      WordsArg1Dist=arg1_head_dist_lst, WordsArg2Dist=arg2_head_dist_lst,
-                      Arg1Mask=arg1_mask, Arg2Mask=arg2_mask,
-                      Piece1Mask=piece1_mask, Piece2Mask=piece2_mask, Piece3Mask=piece3_mask,
-                      RelationName=rel_name)
-    return sample
+def get_sample(uid, Id, sent, arg1, arg2, arg1_start, arg1_end, arg2_start, arg2_end, rel_name):
+    sent = sent.strip()
+    return get_samples([(uid, Id, sent, sent.split(), arg1, arg2, arg1_start, arg1_end, arg2_start, arg2_end,
+                         rel_name)])[0]
 
 
 def get_data(lines, is_training_data=False):
-    custom_print(len(lines))
-    samples = []
-    uid = 1
-    cnt = 0
-    out_of_len = 0
-    for i in range(0, len(lines)):
-        line = lines[i].strip()
-        data = json.loads(line)
-        sent = data['sentText']
-        if is_training_data and len(sent.split()) > max_sent_len:
-            out_of_len += 1
-            continue
-        for rel_mention in data['relationMentions']:
-            arg1 = rel_mention['arg1Text']
-            arg2 = rel_mention['arg2Text']
-            rel_name = rel_mention['relationName']
-
-            if is_training_data and rel_name not in relation_cls_label_map:
-                continue
-            if rel_name not in relation_cls_label_map:
-                cnt += 1
+    mentions, stats = get_mentions(lines, is_training_data)
+    print_data_stats(stats, is_training_data)
+    return get_samples(mentions)
 
-            sample = get_sample(uid, data['sentId'], sent, arg1, arg2,
-                                int(rel_mention['arg1StartIndex']), int(rel_mention['arg1EndIndex']),
-                                int(rel_mention['arg2StartIndex']), int(rel_mention['arg2EndIndex']),
-                                rel_name)
-            samples.append(sample)
-            uid += 1
 
-    custom_print(cnt)
-    if is_training_data:
-        custom_print(out_of_len)
-    return samples
+def get_file_hash(file_path, hasher):
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            hasher.update(block)
+
+
+def get_data_cache_path(file_path, is_training_data=False):
+    """
+    Returns the compiled dataset folder of a source file, keyed by the file content, the relation list
+    and the preprocessing hyperparameters
+    """
+    hasher = hashlib.sha1()
+    get_file_hash(file_path, hasher)
+    hasher.update('\n'.join(relation_cls_label_map).encode('utf-8'))
+    params = [data_cache_version, is_training_data, max_sent_len, ctx_len, max_word_arg_head_dist, word_density]
+    hasher.update(json.dumps(params).encode('utf-8'))
+    file_name = os.path.splitext(os.path.basename(file_path))[0]
+    return os.path.join(data_cache_dir, file_name + '-' + hasher.hexdigest()[:16])
+
+
+def save_compiled_data(compiled, cache_path):
+    """
+    Writes the arrays of a compiled dataset as .npy files and its strings in meta.pkl
+    """
+    tmp_path = cache_path + '.tmp' + str(os.getpid())
+    os.makedirs(tmp_path)
+    for key in compiled_arrays:
+        np.save(os.path.join(tmp_path, key + '.npy'), compiled[key])
+    meta = dict((key, value) for key, value in compiled.items() if key not in compiled_arrays)
+    with open(os.path.join(tmp_path, 'meta.pkl'), 'wb') as f:
+        pickle.dump(meta, f, protocol=pickle.HIGHEST_PROTOCOL)
+    try:
+        os.rename(tmp_path, cache_path)
+    except OSError:
+        # another run compiled the same data first
+        shutil.rmtree(tmp_path)
+
+
+def load_compiled_data(cache_path):
+    """
+    Loads a compiled dataset with its arrays memory-mapped
+    """
+    with open(os.path.join(cache_path, 'meta.pkl'), 'rb') as f:
+        compiled = pickle.load(f)
+    for key in compiled_arrays:
+        compiled[key] = np.load(os.path.join(cache_path, key + '.npy'), mmap_mode='r')
+    return compiled
+
+
+def iter_data(file_path, is_training_data=False):
+    """
+    Streams the samples of a JSON lines file indexed in word_vocab, in chunks of data_chunk_size lines without
+    reading the whole file first. The words of a chunk are looked up through its own word table and never
+    added to the data word table, so that memory does not grow with the file.
+    """
+    stats = dict()
+    with open(file_path) as reader:
+        for mentions in iter_mentions(reader, is_training_data, data_chunk_size, stats):
+            compiled = compile_mentions(mentions)
+            samples = get_compiled_samples(compiled, mentions[0][0], shared_words=False)
+            index_data(samples, compiled['word_table'])
+            yield samples
+    print_data_stats(stats, is_training_data)
+
+
+def get_byte_ranges(file_path, num_parts):
+    """
+    Splits a file into at most num_parts (start, end) byte ranges aligned to line starts
+    """
+    file_size = os.path.getsize(file_path)
+    bounds = [0]
+    with open(file_path, 'rb') as f:
+        for i in range(1, num_parts):
+            f.seek(max(bounds[-1], int(file_size * i / num_parts) - 1))
+            f.readline()
+            if f.tell() > bounds[-1]:
+                bounds.append(min(f.tell(), file_size))
+    if bounds[-1] < file_size:
+        bounds.append(file_size)
+    return [(bounds[i], bounds[i + 1]) for i in range(0, len(bounds) - 1) if bounds[i] < bounds[i + 1]]
+
+
+def read_byte_range(file_path, start, end, is_training_data=False):
+    lines = []
+    with open(file_path, 'rb') as f:
+        f.seek(start)
+        pos = start
+        while pos < end:
+            line = f.readline()
+            if len(line) == 0:
+                break
+            pos += len(line)
+            lines.append(line)
+    mentions, stats = get_mentions(lines, is_training_data)
+    return compile_mentions(mentions, stats)
+
+
+def get_data_parallel(file_path, is_training_data=False, num_workers=4):
+    """
+    Parses and compiles the byte ranges of a file in a process pool and merges them in file order,
+    summing the statistics as the serial path does
+    """
+    ranges = get_byte_ranges(file_path, 4 * num_workers)
+    # workers rely on the hyperparameters set in __main__, so they are forked rather than spawned
+    pool = multiprocessing.get_context('fork').Pool(num_workers)
+    try:
+        parts = pool.starmap(read_byte_range, [(file_path, start, end, is_training_data) for start, end in ranges])
+    finally:
+        pool.close()
+        pool.join()
+
+    stats = {'lines': 0, 'cnt': 0, 'out_of_len': 0}
+    for part in parts:
+        for key in stats:
+            stats[key] += part['stats'][key]
+    return merge_compiled(parts, stats)
+
+
+def get_compiled_data(file_path, is_training_data=False, num_workers=1):
+    if num_workers > 1:
+        return get_data_parallel(file_path, is_training_data, num_workers)
+    stats = dict()
+    with open(file_path) as reader:
+        parts = [compile_mentions(mentions)
+                 for mentions in iter_mentions(reader, is_training_data, data_chunk_size, stats)]
+    return merge_compiled(parts, stats)
+
+
+def is_same_data(data1, data2):
+    if len(data1) != len(data2):
+        return False
+    for sample1, sample2 in zip(data1, data2):
+        for value1, value2 in zip(sample1, sample2):
+            if isinstance(value1, np.ndarray):
+                if not np.array_equal(value1, value2):
+                    return False
+            elif value1 != value2:
+                return False
+    return True
+
+
+def check_parallel_data(file_path, is_training_data=False):
+    """
+    Checks that the parallel preprocessing gives the same samples and statistics as the serial one
+    """
+    serial_data = get_compiled_data(file_path, is_training_data)
+    parallel_data = get_data_parallel(file_path, is_training_data, data_workers)
+    is_same = serial_data['stats'] == parallel_data['stats'] and \
+        is_same_data(get_compiled_samples(serial_data), get_compiled_samples(parallel_data))
+    custom_print(file_path, 'serial:', len(serial_data['labels']), 'parallel:', len(parallel_data['labels']),
+                 'identical:', is_same)
+    return is_same
 
 
 def read_data(file_path, is_training_data=False):
-    reader = open(file_path)
-    lines = reader.readlines()
-    reader.close()
+    cache_path = None
+    if use_data_cache:
+        cache_path = get_data_cache_path(file_path, is_training_data)
+        if os.path.exists(cache_path):
+            compiled = load_compiled_data(cache_path)
+            print_data_stats(compiled['stats'], is_training_data)
+            return get_compiled_samples(compiled)
+
+    compiled = get_compiled_data(file_path, is_training_data, data_workers)
+    print_data_stats(compiled['stats'], is_training_data)
+    if cache_path is not None and is_writable_dir(data_cache_dir):
+        save_compiled_data(compiled, cache_path)
+    return get_compiled_samples(compiled)
+
+
+def get_threshold_counts(data, preds, thresholds):
+    """
+    Returns the predicted, gold and correct positive counts of get_F1 at every threshold. The prediction
+    confidences are sorted once and the counts above each threshold are read from cumulative sums.
+    """
+    preds = np.asarray(preds)
+    pred_labels = preds.argmax(axis=-1)
+    # compare as get_F1 always did, i.e. a confidence scalar against a python float threshold
+    cmp_dtype = (preds.dtype.type(0) + 0.0).dtype
+    conf = preds.max(axis=-1).astype(cmp_dtype)
 
-    # lines = lines[0:min(1000, len(lines))]
-    # dep_lines = dep_lines[0:min(1000, len(dep_lines))]
+    is_ignore_cls = np.array([rel_name in ignore_rel_list for rel_name in relation_cls_label_map], dtype=bool)
+    gt_mask = np.array([d.RelationName not in ignore_rel_list for d in data], dtype=bool)
+    labels = np.array([d.Label for d in data], dtype=np.int64)
+    pred_pos_mask = ~is_ignore_cls[pred_labels]
+    correct_mask = gt_mask & (labels == pred_labels)
 
-    data = get_data(lines, is_training_data)
-    return data
+    order = np.argsort(-conf, kind='stable')
+    sorted_conf = conf[order][::-1]
+    pred_pos_cum = np.concatenate(([0], np.cumsum(pred_pos_mask[order])))
+    correct_pos_cum = np.concatenate(([0], np.cumsum(correct_mask[order])))
 
+    above_cnt = len(conf) - np.searchsorted(sorted_conf, np.array(thresholds, dtype=cmp_dtype), side='right')
+    return pred_pos_cum[above_cnt].tolist(), int(gt_mask.sum()), correct_pos_cum[above_cnt].tolist()
 
-def get_threshold(data, preds):
-    max_f1 = -1.0
-    best_th = -1.0
+
+def get_F1_sweep(data, preds, th_step, th_end):
+    """
+    Returns the (threshold, precision, recall, F1) of the thresholds from 0 to th_end by th_step
+    """
+    thresholds = []
     cur_th = 0.0
-    while cur_th < 1.0:
-        pred_pos, gt_pos, correct_pos = get_F1(data, preds, th=cur_th)
+    while cur_th < th_end:
+        thresholds.append(cur_th)
+        cur_th += th_step
+    pred_pos_lst, gt_pos, correct_pos_lst = get_threshold_counts(data, preds, thresholds)
+    sweep = []
+    for cur_th, pred_pos, correct_pos in zip(thresholds, pred_pos_lst, correct_pos_lst):
         p = float(correct_pos) / (pred_pos + 1e-8)
         r = float(correct_pos) / (gt_pos + 1e-8)
         cur_f1 = (2 * p * r) / (p + r + 1e-8)
+        sweep.append((cur_th, p, r, cur_f1))
+    return sweep
+
+
+def get_threshold(data, preds):
+    max_f1 = -1.0
+    best_th = -1.0
+    for cur_th, p, r, cur_f1 in get_F1_sweep(data, preds, 0.01, 1.0):
         if cur_f1 > max_f1:
             max_f1 = cur_f1
             best_th = cur_th
-        cur_th += 0.01
     return best_th
 
 
 def get_F1(data, preds, th=0.0):
-    gt_pos = 0
-    pred_pos = 0
-    correct_pos = 0
-    for i in range(0, len(data)):
-        org_rel_name = data[i].RelationName
-        pred_val = np.argmax(preds[i])
-        pred_rel_name = list(relation_cls_label_map)[pred_val]
-        if org_rel_name not in ignore_rel_list:
-            gt_pos += 1
-        if pred_rel_name not in ignore_rel_list and np.max(preds[i]) > th:
-            pred_pos += 1
-        if org_rel_name == pred_rel_name and org_rel_name not in ignore_rel_list and np.max(preds[i]) > th:
-            correct_pos += 1
-    return pred_pos, gt_pos, correct_pos
+    pred_pos_lst, gt_pos, correct_pos_lst = get_threshold_counts(data, preds, [th])
+    return pred_pos_lst[0], gt_pos, correct_pos_lst[0]
 
 
 def write_PR_curve(data, preds, file_name):
-    cur_th = 0.0
     writer = open(file_name, 'w')
     writer.write('Threshold,Prec.,Rec.,F1\n')
-    while cur_th < 1.001:
-        pred_pos, gt_pos, correct_pos = get_F1(data, preds, th=cur_th)
-        p = float(correct_pos) / (pred_pos + 1e-8)
-        r = float(correct_pos) / (gt_pos + 1e-8)
-        cur_f1 = (2 * p * r) / (p + r + 1e-8)
+    for cur_th, p, r, cur_f1 in get_F1_sweep(data, preds, 0.001, 1.001):
         writer.write(','.join([str(cur_th)[:6], str(p)[:6], str(r)[:6], str(cur_f1)[:6]]) + '\n')
-        cur_th += 0.001
+    writer.close()
 
 
-def pr_curve(infile, outfile):
+def get_standard_pr(p_arr, r_arr, eps=0.01):
+    """
+    Resamples a PR curve at recall 0.0, 0.01, ..., 1.0 using the PR point of nearest recall within eps
+    """
+    p_arr = np.asarray(p_arr, dtype=np.float64)
+    r_arr = np.asarray(r_arr, dtype=np.float64)
+    grid = []
+    r = 0.0
+    while r <= 1.0:
+        grid.append(r)
+        r += 0.01
+    grid = np.array(grid)
+    if len(r_arr) == 0:
+        return np.zeros(0), np.zeros(0)
+    # nearest distinct recall on either side of each grid point, ties going to the earlier PR point
+    uniq_r, first_idx = np.unique(r_arr, return_index=True)
+    right = np.searchsorted(uniq_r, grid).clip(max=len(uniq_r) - 1)
+    left = (right - 1).clip(min=0)
+    diff_l = np.abs(uniq_r[left] - grid)
+    diff_r = np.abs(uniq_r[right] - grid)
+    use_left = (diff_l < diff_r) | ((diff_l == diff_r) & (first_idx[left] < first_idx[right]))
+    nearest = np.where(use_left, left, right)
+    min_diff = np.where(use_left, diff_l, diff_r)
+    p = np.where(min_diff < eps, p_arr[first_idx[nearest]], 0.0)
+    keep = p != 0.0
+    return p[keep], grid[keep]
+
+
+def get_auc(p_arr, r_arr, min_p, min_r):
+    p_arr = np.asarray(p_arr, dtype=np.float64)
+    r_arr = np.asarray(r_arr, dtype=np.float64)
+    keep = (p_arr >= min_p) & (r_arr >= min_r)
+    p_arr, r_arr = p_arr[keep], r_arr[keep]
+    return float(np.sum(0.5 * (p_arr[:-1] + p_arr[1:]) * (r_arr[1:] - r_arr[:-1])))
+
+
+def get_pr_auc(data, preds, min_p, min_r, pr_file=None):
+    """
+    Returns the AUC of the resampled PR curve of the predictions, optionally writing the curve to pr_file
+    """
+    sweep = get_F1_sweep(data, preds, 0.001, 1.001)
+    p_arr, r_arr = get_standard_pr([row[1] for row in sweep], [row[2] for row in sweep])
+    if pr_file is not None:
+        write_standard_pr(p_arr, r_arr, pr_file)
+    return get_auc(p_arr, r_arr, min_p, min_r)
+
+
+def read_pr_file(infile, p_col, r_col):
     reader = open(infile)
     lines = reader.readlines()
     reader.close()
-    pr_lst = list()
-    for line in lines[1:]:
-        parts = line.strip().split(',')
-        p = float(parts[1])
-        r = float(parts[2])
-        pr_lst.append((p, r))
-    eps = 0.01
-    standard_pr_lst = []
+    parts = [line.strip().split(',') for line in lines[1:]]
+    return [float(cols[p_col]) for cols in parts], [float(cols[r_col]) for cols in parts]
 
-    r = 0.0
-    while r <= 1.0:
-        p = 0
-        min_diff = 10.0
-        for i in range(0, len(pr_lst)):
-            if abs(pr_lst[i][1] - r) < eps and abs(pr_lst[i][1] - r) < min_diff:
-                min_diff = abs(pr_lst[i][1] - r)
-                p = pr_lst[i][0]
-        if p != 0.0:
-            standard_pr_lst.append((p, r))
-        r += 0.01
+
+def write_standard_pr(p_arr, r_arr, outfile):
     writer = open(outfile, 'w')
     writer.write('Rec.,Prec.\n')
-    for pair in standard_pr_lst:
-        writer.write(','.join([str(pair[1])[:6], str(pair[0])]) + '\n')
+    for p, r in zip(p_arr, r_arr):
+        writer.write(','.join([str(r)[:6], str(p)]) + '\n')
     writer.close()
 
 
+def pr_curve(infile, outfile):
+    p_lst, r_lst = read_pr_file(infile, 1, 2)
+    p_arr, r_arr = get_standard_pr(p_lst, r_lst)
+    write_standard_pr(p_arr.tolist(), r_arr.tolist(), outfile)
+
+
 def cal_auc(infile, min_p, min_r):
-    reader = open(infile)
-    lines = reader.readlines()
-    reader.close()
-    pr_lst = []
-    for line in lines[1:]:
-        parts = line.strip().split(',')
-        p = float(parts[1])
-        r = float(parts[0])
-        if p >= min_p and r >= min_r:
-            pr_lst.append((p, r))
-    auc = 0.0
-    for i in range(0, len(pr_lst) - 1):
-        auc += 0.5 * (pr_lst[i][0] + pr_lst[i+1][0]) * (pr_lst[i+1][1] - pr_lst[i][1])
+    p_lst, r_lst = read_pr_file(infile, 1, 0)
+    auc = get_auc(p_lst, r_lst, min_p, min_r)
     custom_print('AUC:', round(auc, 3))
 
 
@@ -333,6 +798,11 @@ def write_pred_file(data, preds, out_file, threshold=0.0):
     # custom_print(len(data))
     # custom_print(len(preds))
     writer = open(out_file, 'w')
+    write_pred_lines(writer, data, preds, threshold)
+    writer.close()
+
+
+def write_pred_lines(writer, data, preds, threshold=0.0):
     out_dct = OrderedDict()
     sent_dct = OrderedDict()
     for i in range(0, len(data)):
@@ -362,29 +832,98 @@ def write_pred_file(data, preds, out_file, threshold=0.0):
         data['sentText'] = sent_dct[sentId]
         data['predictedRelationMentions'] = out_dct[sentId]
         writer.write(json.dumps(data) + '\n')
-    writer.close()
 
 
-def shuffle_data(data):
+def predict_file(file_path, model, model_id, out_file, threshold=0.0):
+    """
+    Streams the samples of a JSON lines file through the model in chunks of data_chunk_size lines and writes
+    the predictions of every chunk to out_file before reading the next one. Returns the number of predicted
+    samples.
+    """
+    sample_cnt = 0
+    with open(out_file, 'w') as writer:
+        for samples in iter_data(file_path):
+            write_pred_lines(writer, samples, predict(samples, model, model_id), threshold)
+            sample_cnt += len(samples)
+    return sample_cnt
+
+
+def shuffle_data(data, sample_pos):
     # custom_print(len(data))
-    data.sort(key=lambda x: x.Len)
-    num_batch = int(len(data) / batch_size)
+    sample_pos = sorted(sample_pos, key=lambda i: data[i].Len)
+    num_batch = int(len(sample_pos) / batch_size)
     rand_idx = random.sample(range(num_batch), num_batch)
-    new_data = []
+    new_pos = []
     for idx in rand_idx:
-        new_data += data[batch_size * idx: batch_size * (idx + 1)]
-    if len(new_data) < len(data):
-        new_data += data[num_batch * batch_size:]
-    return new_data
+        new_pos += sample_pos[batch_size * idx: batch_size * (idx + 1)]
+    if len(new_pos) < len(sample_pos):
+        new_pos += sample_pos[num_batch * batch_size:]
+    return np.array(new_pos, dtype=np.int64)
+
+
+def shuffle_bucket_data(data, sample_pos):
+    """
+    Groups the samples into buckets of bucket_width lengths, merging a bucket of a single sample into its
+    neighbour. Every bucket is shuffled and cut into equal batches of at most batch_tokens padded tokens at the
+    bucket's longest sentence, with at least two samples a batch, then the batch order is shuffled.
+    """
+    buckets = OrderedDict()
+    for idx in sorted(sample_pos, key=lambda i: data[i].Len):
+        bucket_idx = data[idx].Len // bucket_width
+        if bucket_idx not in buckets:
+            buckets[bucket_idx] = []
+        buckets[bucket_idx].append(idx)
+
+    merged_buckets = []
+    for bucket in buckets.values():
+        if len(merged_buckets) > 0 and (len(bucket) == 1 or len(merged_buckets[-1]) == 1):
+            merged_buckets[-1] += bucket
+        else:
+            merged_buckets.append(bucket)
+
+    batches = []
+    for bucket in merged_buckets:
+        max_len = max(data[idx].Len for idx in bucket)
+        max_batch_size = max(1, batch_tokens // max_len)
+        # only a budget below three of the longest sentences can be exceeded, to avoid a batch of one sample
+        num_batch = max(1, min(int(math.ceil(len(bucket) / float(max_batch_size))), len(bucket) // 2))
+        random.shuffle(bucket)
+        for i in range(0, num_batch):
+            batches.append(bucket[len(bucket) * i // num_batch:len(bucket) * (i + 1) // num_batch])
+    random.shuffle(batches)
+
+    new_pos = []
+    batch_bounds = []
+    for cur_batch in batches:
+        batch_bounds.append((len(new_pos), len(new_pos) + len(cur_batch)))
+        new_pos += cur_batch
+    return np.array(new_pos, dtype=np.int64), batch_bounds
+
+
+def get_train_batches(data, sample_pos=None):
+    """
+    Returns the shuffled positions in data of the samples of an epoch and its batch bounds, using fixed
+    batch_size batches when batch_tokens is 0 and token budget batches otherwise. sample_pos restricts the
+    epoch to a subset of data.
+    """
+    if sample_pos is None:
+        sample_pos = range(0, len(data))
+    if batch_tokens == 0:
+        new_pos = shuffle_data(data, sample_pos)
+        return new_pos, get_batch_bounds(len(new_pos), batch_size)
+    return shuffle_bucket_data(data, sample_pos)
 
 
 def get_class_label_map(rel_file):
-    cls_label_map = collections.OrderedDict()
-    label_cls_map = collections.OrderedDict()
     reader = open(rel_file)
     lines = reader.readlines()
     reader.close()
+    return get_label_maps(lines)
+
 
+def get_label_maps(lines):
+    cls_label_map = collections.OrderedDict()
+    label_cls_map = collections.OrderedDict()
     label = 0
     for line in lines:
         line = line.strip()
@@ -405,10 +944,10 @@ def get_rel_counts(data):
 
 
 def get_max_len(sample_batch):
-    max_len = len(sample_batch[0].Words)
+    max_len = sample_batch[0].Len
     for idx in range(1, len(sample_batch)):
-        if len(sample_batch[idx].Words) > max_len:
-            max_len = len(sample_batch[idx].Words)
+        if sample_batch[idx].Len > max_len:
+            max_len = sample_batch[idx].Len
     return max_len
 
 
@@ -422,86 +961,136 @@ def get_ent_indicator_seq(indicator, max_len):
     return indicator_seq
 
 
-def get_distance_seq(dist, max_len):
-    head_dist_seq = list()
-    for ind in range(0, len(dist)):
-        head_dist_seq.append(dist[ind])
-    pad_len = max_len - len(dist)
-    for i in range(0, pad_len):
-        head_dist_seq.append(0)
-    return head_dist_seq
+def index_data(data, words=None):
+    """
+    Resolves the word and argument head ids of the samples in word_vocab. It runs once after the vocabulary
+    is built or loaded, so that batching never looks up strings. words is the word table that the sample
+    Words index, data_words by default.
+    """
+    if words is None:
+        words = data_words
+    unk_id = word_vocab['<UNK>']
+    vocab_ids = np.array([word_vocab.get(word, unk_id) for word in words], dtype=np.int32)
+    sent_word_ids = dict()
+    for sample in data:
+        # the mentions of a sentence share their token array, so they share the id array as well
+        if id(sample.Words) not in sent_word_ids:
+            sent_word_ids[id(sample.Words)] = vocab_ids[sample.Words]
+        sample.WordIds = sent_word_ids[id(sample.Words)]
+        sample.Arg1Id = word_vocab.get(sample.Arg1.split()[-1], unk_id)
+        sample.Arg2Id = word_vocab.get(sample.Arg2.split()[-1], unk_id)
+
+
+def get_batch_data(cur_samples):
+    """
+    Collates the samples into one packed int64 buffer holding the [7, B, T] word ids, argument head distances,
+    word mask and piece masks, followed by the [3, B] argument head ids and relation labels
+    """
+    batch_len = len(cur_samples)
+    max_len = get_max_len(cur_samples)
+    seq_size = 7 * batch_len * max_len
+    packed = torch.zeros(seq_size + 3 * batch_len, dtype=torch.long)
+    packed_seq = packed.numpy()[:seq_size].reshape(7, batch_len, max_len)
+    packed_rows = packed.numpy()[seq_size:].reshape(3, batch_len)
+
+    features = get_features([sample.Len for sample in cur_samples],
+                            [sample.Arg1Start for sample in cur_samples], [sample.Arg1End for sample in cur_samples],
+                            [sample.Arg2Start for sample in cur_samples], [sample.Arg2End for sample in cur_samples],
+                            max_len, ctx_features=False)
+    for idx, sample in enumerate(cur_samples):
+        packed_seq[0, idx, :len(sample.WordIds)] = sample.WordIds
+        packed_rows[0, idx] = sample.Arg1Id
+        packed_rows[1, idx] = sample.Arg2Id
+        packed_rows[2, idx] = sample.Label
+    packed_seq[1] = features['arg1LinDist']
+    packed_seq[2] = features['arg2LinDist']
+    packed_seq[3] = features['wordsMask']
+    packed_seq[4] = features['piece1Mask']
+    packed_seq[5] = features['piece2Mask']
+    packed_seq[6] = features['piece3Mask']
+    return batch_len, max_len, packed
+
+
+def get_batch_tensors(batch_data):
+    """
+    Moves a packed batch to the device in one copy and returns views of its int64 ids and labels and bool masks
+    """
+    batch_len, max_len, packed = batch_data
+    seq_size = 7 * batch_len * max_len
+    packed = packed.to(device, non_blocking=True)
+    packed_seq = packed[:seq_size].view(7, batch_len, max_len)
+    packed_rows = packed[seq_size:].view(3, batch_len)
+    masks = packed_seq[3:].bool()
+    return {'words': packed_seq[0],
+            'arg1LinDist': packed_seq[1],
+            'arg2LinDist': packed_seq[2],
+            'wordsMask': masks[0],
+            'piece1Mask': masks[1],
+            'piece2Mask': masks[2],
+            'piece3Mask': masks[3],
+            'arg1': packed_rows[0].view(batch_len, 1),
+            'arg2': packed_rows[1].view(batch_len, 1),
+            'relation': packed_rows[2]}
+
+
+def get_batch_bounds(data_len, cur_batch_size):
+    """
+    Returns the (start, end) indices of the batches of a dataset, merging a last batch of a single sample
+    into the previous one
+    """
+    batch_count = int(math.ceil(data_len / cur_batch_size))
+    move_last_batch = False
+    if data_len - cur_batch_size * (batch_count - 1) == 1:
+        move_last_batch = True
+        batch_count -= 1
+    batch_bounds = list()
+    for batch_idx in range(0, batch_count):
+        batch_start = batch_idx * cur_batch_size
+        batch_end = min(data_len, batch_start + cur_batch_size)
+        if batch_idx == batch_count - 1 and move_last_batch:
+            batch_end = data_len
+        batch_bounds.append((batch_start, batch_end))
+    return batch_bounds
 
 
-def get_words_index_seq(path_words, max_len):
-    path_seq = list()
-    for word in path_words:
-        if word in word_vocab:
-            path_seq.append(word_vocab[word])
-        else:
-            path_seq.append(word_vocab['<UNK>'])
-    pad_len = max_len - len(path_words)
-    for i in range(0, pad_len):
-        path_seq.append(word_vocab['<PAD>'])
-    return path_seq
+def get_batch_samples(samples, batch_start, batch_end, sample_pos=None):
+    if sample_pos is None:
+        return samples[batch_start:batch_end]
+    return [samples[idx] for idx in sample_pos[batch_start:batch_end]]
 
 
-def get_padded_mask(mask, max_len):
-    mask_seq = list()
-    for i in range(0, len(mask)):
-        mask_seq.append(mask[i])
-    pad_len = max_len - len(mask)
-    for i in range(0, pad_len):
-        mask_seq.append(0)
-    return mask_seq
+class BatchDataset(torch.utils.data.Dataset):
+    def __init__(self, samples, batch_bounds, sample_pos=None):
+        self.samples = samples
+        self.batch_bounds = batch_bounds
+        self.sample_pos = sample_pos
+
+    def __len__(self):
+        return len(self.batch_bounds)
 
+    def __getitem__(self, idx):
+        batch_start, batch_end = self.batch_bounds[idx]
+        return get_batch_data(get_batch_samples(self.samples, batch_start, batch_end, self.sample_pos))
 
-def get_batch_data(cur_samples, is_training=False):
+
+def iter_batches(samples, batch_bounds, sample_pos=None):
     """
-    Returns the training samples and labels as numpy array
+    Yields the GPU tensors of the batches in order, where the batch bounds index sample_pos when given and
+    samples otherwise. With batch_workers > 0 the batches are collated in worker processes, batch_prefetch
+    batches ahead per worker, while the model runs on the current one.
     """
-    max_len = get_max_len(cur_samples)
-
-    words_list = list()
-    words_mask_list = list()
-    words_arg1_dist_list = list()
-    words_arg2_dist_list = list()
-    arg1_list = list()
-    arg2_list = list()
-    piece1mask_list = list()
-    piece2mask_list = list()
-    piece3mask_list = list()
-
-    rel_labels_list = list()
-
-    for sample in cur_samples:
-        words_list.append(get_words_index_seq(sample.Words, max_len))
-        words_mask_list.append(get_padded_mask(sample.WordsMask, max_len))
-        words_arg1_dist_list.append(get_distance_seq(sample.WordsArg1Dist, max_len))
-        words_arg2_dist_list.append(get_distance_seq(sample.WordsArg2Dist, max_len))
-
-        piece1mask_list.append(get_padded_mask(sample.Piece1Mask, max_len))
-        piece2mask_list.append(get_padded_mask(sample.Piece2Mask, max_len))
-        piece3mask_list.append(get_padded_mask(sample.Piece3Mask, max_len))
-
-        arg1_list.append(get_words_index_seq([sample.Arg1.split()[-1]], 1))
-        arg2_list.append(get_words_index_seq([sample.Arg2.split()[-1]], 1))
-
-        if is_training:
-            labels = [0 for i in range(len(relation_cls_label_map))]
-            labels[relation_cls_label_map[sample.RelationName]] = 1
-            rel_labels_list.append(labels)
-
-    return max_len, \
-            {'words': np.array(words_list, dtype=np.float32),
-             'wordsMask': np.array(words_mask_list),
-             'arg1LinDist': np.array(words_arg1_dist_list),
-             'arg2LinDist': np.array(words_arg2_dist_list),
-             'piece1Mask': np.array(piece1mask_list),
-             'piece2Mask': np.array(piece2mask_list),
-             'piece3Mask': np.array(piece3mask_list),
-             'arg1': np.array(arg1_list),
-             'arg2': np.array(arg2_list)}, \
-            {'relation': np.array(rel_labels_list, dtype=np.int32)}
+    if batch_workers == 0:
+        for batch_start, batch_end in batch_bounds:
+            yield get_batch_tensors(get_batch_data(get_batch_samples(samples, batch_start, batch_end, sample_pos)))
+        return
+    # a private generator keeps the loader from drawing from the global torch RNG
+    loader = torch.utils.data.DataLoader(BatchDataset(samples, batch_bounds, sample_pos), batch_size=None,
+                                         shuffle=False,
+                                         num_workers=batch_workers, prefetch_factor=batch_prefetch,
+                                         pin_memory=pin_batch_memory and device.type == 'cuda',
+                                         multiprocessing_context='fork', generator=torch.Generator())
+    for batch_data in loader:
+        yield get_batch_tensors(batch_data)
 
 
 # Models
@@ -548,49 +1137,52 @@ class CNN_Layer(nn.Module):
         return output
 
 
+def piecewise_max(input, piece_mask):
+    masked_input = input.unsqueeze(1).masked_fill(~piece_mask.unsqueeze(2), -float('inf'))
+    return torch.max(masked_input, 3)
+
+
+class PiecewiseMaxPool(torch.autograd.Function):
+    """
+    Max-pools a [B, F, T] convolution output over each of the [B, P, T] piece masks into [B, P, F] with one
+    masked reduction over a stacked piece dimension. Only the argmax positions are kept for the backward,
+    which scatters the gradients back onto them.
+    """
+    @staticmethod
+    def forward(ctx, input, piece_mask):
+        output, indices = piecewise_max(input, piece_mask)
+        ctx.save_for_backward(indices)
+        ctx.input_size = input.size()
+        return output
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        indices, = ctx.saved_tensors
+        grad_input = grad_output.new_zeros(ctx.input_size)
+        # last piece first, the order in which autograd summed the gradients of the per-piece pooling
+        grad_input.scatter_add_(2, indices.flip(1).transpose(1, 2), grad_output.flip(1).transpose(1, 2))
+        return grad_input, None
+
+
 class PCNN_Layer(nn.Module):
     def __init__(self, input_dim, num_filter):
         super(PCNN_Layer, self).__init__()
         self.tri_conv = nn.Conv1d(input_dim, num_filter, 3, padding=1)
 
     def forward(self, input, mask, p1mask, p2mask, p3mask):
-        x1_mask = p1mask.bool()
-        mask_copy = x1_mask.clone()
-        x1_mask[mask_copy == 0] = 1
-        x1_mask[mask_copy == 1] = 0
-
-        x2_mask = p2mask.bool()
-        mask_copy = x2_mask.clone()
-        x2_mask[mask_copy == 0] = 1
-        x2_mask[mask_copy == 1] = 0
-
-        x3_mask = p3mask.bool()
-        mask_copy = x3_mask.clone()
-        x3_mask[mask_copy == 0] = 1
-        x3_mask[mask_copy == 1] = 0
+        piece_mask = torch.stack((p1mask.bool(), p2mask.bool(), p3mask.bool()), 1)
 
         mask = mask.unsqueeze(2)
         input = torch.mul(input, mask)
         input = input.permute(0, 2, 1)
         output = self.tri_conv(input)
 
-        x1_mask = x1_mask.unsqueeze(1)  # .repeat(1, 1, self.input_dim)
-        x2_mask = x2_mask.unsqueeze(1)  # .repeat(1, 1, self.input_dim)
-        x3_mask = x3_mask.unsqueeze(1)  # .repeat(1, 1, self.input_dim)
-
-        piece1 = output.clone()
-        piece1.data.masked_fill_(x1_mask.data, -float('inf'))
-        piece1 = torch.tanh(torch.max(piece1, 2)[0])
-
-        piece2 = output.clone()
-        piece2.data.masked_fill_(x2_mask.data, -float('inf'))
-        piece2 = torch.tanh(torch.max(piece2, 2)[0])
-
-        piece3 = output.clone()
-        piece3.data.masked_fill_(x3_mask.data, -float('inf'))
-        piece3 = torch.tanh(torch.max(piece3, 2)[0])
-
-        return torch.cat((piece1, piece2, piece3), 1)
+        if torch.onnx.is_in_onnx_export():
+            # the exporter records plain ops, the backward is not needed there
+            pieces = torch.tanh(piecewise_max(output, piece_mask)[0])
+        else:
+            pieces = torch.tanh(PiecewiseMaxPool.apply(output, piece_mask))
+        return pieces.view(pieces.size()[0], -1)
 
 
 class CNN(nn.Module):
@@ -702,11 +1294,20 @@ class EA(nn.Module):
         self.logsoftmax = nn.LogSoftmax()
         self.softmax = nn.Softmax()
 
+    def get_attn_proj(self, attn_a, input, arg_embeds):
+        """
+        Returns attn_a applied to the input concatenated with the argument embedding at every time step. The
+        linear layer is split into a per-token projection of the input and a per-row projection of the
+        argument that is broadcast over time, so that the repeated argument embeddings are never built.
+        """
+        input_proj = F.linear(input, attn_a.weight[:, :self.input_dim])
+        arg_proj = F.linear(arg_embeds.view(arg_embeds.size()[0], 1, -1), attn_a.weight[:, self.input_dim:])
+        return input_proj + arg_proj
+
     def forward(self,
                 words_seq, words_mask, words_arg1_dist_seq, words_arg2_dist_seq,
                 piece1_mask, piece2_mask, piece3_mask, arg1, arg2, is_training=False):
         word_embeds = self.word_embeddings(words_seq)
-        time_steps = word_embeds.size()[1]
         dist1_embeds = self.word_arg1_head_distance_embed(words_arg1_dist_seq)
         dist2_embeds = self.word_arg2_head_distance_embed(words_arg2_dist_seq)
         arg1_embeds = self.word_embeddings(arg1)
@@ -719,30 +1320,22 @@ class EA(nn.Module):
             arg1_embeds = self.dropout(arg1_embeds)
             arg2_embeds = self.dropout(arg2_embeds)
 
-        arg1_embeds = arg1_embeds.squeeze().unsqueeze(1).repeat(1, time_steps, 1)
-        arg2_embeds = arg2_embeds.squeeze().unsqueeze(1).repeat(1, time_steps, 1)
-
-        x_mask = words_mask.bool()
-        mask_copy = x_mask.clone()
-        x_mask[mask_copy == 0] = 1
-        x_mask[mask_copy == 1] = 0
+        x_mask = ~words_mask.bool()
 
         input = torch.cat((word_embeds, dist1_embeds, dist2_embeds), 2)
         cnn_output = self.cnn(input, words_mask)
 
-        ent1_attn_input = torch.cat((input, arg1_embeds), 2)
-        ent1_attn = torch.tanh(self.ent1_attn_a(ent1_attn_input))
-        ent1_attn = self.ent1_attn_r(ent1_attn).squeeze()
-        ent1_attn.data.masked_fill_(x_mask.data, -float('inf'))
+        ent1_attn = torch.tanh(self.get_attn_proj(self.ent1_attn_a, input, arg1_embeds))
+        ent1_attn = self.ent1_attn_r(ent1_attn).squeeze(2)
+        ent1_attn = ent1_attn.masked_fill(x_mask, -float('inf'))
         ent1_attn = F.softmax(ent1_attn, dim=-1).unsqueeze(1)
-        ent1_attn_vecs = torch.bmm(ent1_attn, input).squeeze()
+        ent1_attn_vecs = torch.bmm(ent1_attn, input).squeeze(1)
 
-        ent2_attn_input = torch.cat((input, arg2_embeds), 2)
-        ent2_attn = torch.tanh(self.ent2_attn_a(ent2_attn_input))
-        ent2_attn = self.ent2_attn_r(ent2_attn).squeeze()
-        ent2_attn.data.masked_fill_(x_mask.data, -float('inf'))
+        ent2_attn = torch.tanh(self.get_attn_proj(self.ent2_attn_a, input, arg2_embeds))
+        ent2_attn = self.ent2_attn_r(ent2_attn).squeeze(2)
+        ent2_attn = ent2_attn.masked_fill(x_mask, -float('inf'))
         ent2_attn = F.softmax(ent2_attn, dim=-1).unsqueeze(1)
-        ent2_attn_vecs = torch.bmm(ent2_attn, input).squeeze()
+        ent2_attn_vecs = torch.bmm(ent2_attn, input).squeeze(1)
 
         rel_probs = self.dense(self.dropout(torch.cat((cnn_output, ent1_attn_vecs, ent2_attn_vecs), 1)))
         # if is_training:
@@ -784,7 +1377,6 @@ class BGWA(nn.Module):
                 words_seq, words_mask, words_arg1_dist_seq, words_arg2_dist_seq,
                 piece1_mask, piece2_mask, piece3_mask, is_training=False):
         word_embeds = self.word_embeddings(words_seq)
-        batch_len = word_embeds.size()[0]
         dist1_embeds = self.word_arg1_head_distance_embed(words_arg1_dist_seq)
         dist2_embeds = self.word_arg2_head_distance_embed(words_arg2_dist_seq)
 
@@ -793,20 +1385,22 @@ class BGWA(nn.Module):
             dist1_embeds = self.dropout(dist1_embeds)
             dist2_embeds = self.dropout(dist2_embeds)
 
-        x_mask = words_mask.bool()
-        mask_copy = x_mask.clone()
-        x_mask[mask_copy == 0] = 1
-        x_mask[mask_copy == 1] = 0
+        x_mask = ~words_mask.bool()
 
         gru_input = torch.cat((word_embeds, dist1_embeds, dist2_embeds), 2)
-        h0 = autograd.Variable(torch.FloatTensor(torch.zeros(lstm_direction, batch_len,
-                                                             int(self.hidden_dim / lstm_direction))))
-        h0 = h0.cuda()
-
-        gru_output, hc = self.gru(gru_input, h0)
+        if is_packed_gru(self.training):
+            # the GRU runs over the words of each sentence only, its outputs are zero beyond them
+            seq_lens = words_mask.sum(1).long().cpu()
+            packed_input = nn.utils.rnn.pack_padded_sequence(gru_input, seq_lens, batch_first=True,
+                                                             enforce_sorted=False)
+            gru_output, hc = self.gru(packed_input)
+            gru_output, _ = nn.utils.rnn.pad_packed_sequence(gru_output, batch_first=True,
+                                                             total_length=gru_input.size()[1])
+        else:
+            gru_output, hc = self.gru(gru_input)
         word_attn = torch.tanh(self.word_attn_a(gru_output))
-        word_attn = self.word_attn_r(word_attn).squeeze()
-        word_attn.data.masked_fill_(x_mask.data, -float('inf'))
+        word_attn = self.word_attn_r(word_attn).squeeze(2)
+        word_attn = word_attn.masked_fill(x_mask, -float('inf'))
         word_attn = F.softmax(word_attn, dim=-1).unsqueeze(2)
         attn_vecs = torch.mul(gru_output, word_attn)
         wa_output = self.wa_pcnn(attn_vecs, words_mask, piece1_mask, piece2_mask, piece3_mask)
@@ -830,86 +1424,419 @@ def get_model(model_id):
         return BGWA()
 
 
-def predict(samples, model, model_id):
+def get_inference_model(model):
+    """
+    Returns the model compiled with torch.compile when compile_models is set, and the model itself otherwise.
+    The compiled artifacts are cached in compile_cache_dir across runs.
+    """
+    if not compile_models:
+        return model
+    if not hasattr(torch, 'compile'):
+        custom_print('compile_models needs torch.compile (pytorch 2), running eagerly')
+        return model
+    if 'TORCHINDUCTOR_CACHE_DIR' not in os.environ and is_writable_dir(compile_cache_dir):
+        os.environ['TORCHINDUCTOR_CACHE_DIR'] = compile_cache_dir
+    return torch.compile(model, dynamic=False)
+
+
+def pad_to_bucket(cur_input):
+    """
+    Pads the sequence inputs of a batch with zeros to the smallest of len_buckets that fits them, or to a
+    multiple of the largest one beyond it, and marks the batch dimension dynamic, so that compiled models see
+    a few sequence lengths only and the smaller last batch does not recompile them
+    """
+    seq_len = cur_input['words'].size()[1]
+    bucket_lens = [bucket_len for bucket_len in len_buckets if bucket_len >= seq_len]
+    if len(bucket_lens) > 0:
+        bucket_len = bucket_lens[0]
+    else:
+        bucket_len = int(math.ceil(seq_len / float(len_buckets[-1]))) * len_buckets[-1]
+    padded_input = dict(cur_input)
+    if bucket_len > seq_len:
+        for key in ['words', 'arg1LinDist', 'arg2LinDist', 'wordsMask', 'piece1Mask', 'piece2Mask', 'piece3Mask']:
+            padded_input[key] = F.pad(cur_input[key], (0, bucket_len - seq_len))
+    # dynamo specializes sizes of one, a batch of a single sample is compiled on its own. The packed GRU of
+    # BGWA also specializes the batch size, it is recompiled for the last batch.
+    if hasattr(torch, '_dynamo') and hasattr(torch._dynamo, 'maybe_mark_dynamic') and \
+            padded_input['words'].size()[0] > 1:
+        for key in model_input_names:
+            torch._dynamo.maybe_mark_dynamic(padded_input[key], 0)
+    return padded_input
+
+
+def is_packed_gru(is_training):
+    """
+    Returns whether the BGWA GRU runs over packed sequences. With legacy_eval_padding it is packed in training
+    only and runs over the padding in evaluation, as the checkpoints trained before pack_gru_input expect.
+    """
+    return pack_gru_input and (is_training or not legacy_eval_padding)
+
+
+def is_padding_invariant(model_id):
+    """
+    Returns whether the outputs of a model do not depend on how its batch is padded. CNN and EA max-pool over
+    the padded positions as well, and so does the GRU of BGWA when it is not packed.
+    """
+    return model_id == 2 or (model_id == 4 and is_packed_gru(False))
+
+
+def get_eval_batch_size(model_id):
+    """
+    Returns the inference batch size of a model, the training batch_size for the padding dependent models
+    with legacy_eval_padding, so that their predictions stay as they were
+    """
+    if legacy_eval_padding and not is_padding_invariant(model_id):
+        return batch_size
+    return eval_batch_size
+
+
+def is_sorted_eval(model_id):
+    """
+    Returns whether a model is evaluated in order of length, which with legacy_eval_padding is left to the
+    padding invariant models, whose predictions do not change with it
+    """
+    if legacy_eval_padding and not is_padding_invariant(model_id):
+        return False
+    return sort_eval_batches
+
+
+def iter_eval_batches(samples, model_id, sort_by_len=None):
+    """
+    Yields the sample indices and GPU tensors of the inference batches. Sorted by length (is_sorted_eval of
+    the model unless sort_by_len is given) the samples run in order of length, so that each batch pads only to
+    its own longest sentence.
+    """
+    if sort_by_len is None:
+        sort_by_len = is_sorted_eval(model_id)
+    if sort_by_len:
+        order = np.argsort([d.Len for d in samples], kind='stable')
+    else:
+        order = np.arange(len(samples))
+    batch_bounds = get_batch_bounds(len(samples), get_eval_batch_size(model_id))
+    for (batch_start, batch_end), cur_input in tqdm(zip(batch_bounds, iter_batches(samples, batch_bounds, order)),
+                                                    total=len(batch_bounds)):
+        if compile_models:
+            cur_input = pad_to_bucket(cur_input)
+        yield order[batch_start:batch_end], cur_input
+
+
+def predict(samples, model, model_id, labels_only=False, sort_by_len=None):
+    """
+    Returns the [N, num_classes] float32 class probabilities of the samples, or with labels_only the argmax
+    labels and their probabilities. sort_by_len overrides the batch order of iter_eval_batches.
+    """
     custom_print('Pred size:', len(samples))
-    pred_batch_size = batch_size
-    batch_count = math.ceil(len(samples) / pred_batch_size)
-    move_last_batch = False
-    if len(samples) - pred_batch_size * (batch_count - 1) == 1:
-        move_last_batch = True
-        batch_count -= 1
-    preds = list()
+    if onnxruntime is not None and isinstance(model, onnxruntime.InferenceSession):
+        preds = predict_onnx(samples, model, model_id, sort_by_len)
+        if labels_only:
+            return preds.argmax(axis=1), preds.max(axis=1)
+        return preds
+    if labels_only:
+        pred_labels = np.zeros(len(samples), dtype=np.int64)
+        pred_conf = np.zeros(len(samples), dtype=np.float32)
+    else:
+        preds = np.zeros((len(samples), len(relation_cls_label_map)), dtype=np.float32)
     model.eval()
+    infer_model = get_inference_model(model)
     np.random.seed(random_seed)
     torch.cuda.manual_seed(random_seed)
     random.seed(random_seed)
-    for batch_idx in tqdm(range(0, batch_count)):
-        batch_start = batch_idx * pred_batch_size
-        batch_end = min(len(samples), batch_start + pred_batch_size)
-        if batch_idx == batch_count - 1 and move_last_batch:
-            batch_end = len(samples)
-
-        cur_batch = samples[batch_start:batch_end]
-        cur_seq_len, cur_input, _ = get_batch_data(cur_batch)
-
-        words_seq = autograd.Variable(torch.from_numpy(cur_input['words'].astype('long')).cuda())
-        words_mask = autograd.Variable(torch.from_numpy(cur_input['wordsMask'].astype('float32')).cuda())
-        arg1_lin_dist = autograd.Variable(torch.from_numpy(cur_input['arg1LinDist'].astype('long')).cuda())
-        arg2_lin_dist = autograd.Variable(torch.from_numpy(cur_input['arg2LinDist'].astype('long')).cuda())
-
-        arg1 = autograd.Variable(torch.from_numpy(cur_input['arg1'].astype('long')).cuda())
-        arg2 = autograd.Variable(torch.from_numpy(cur_input['arg2'].astype('long')).cuda())
-
-        piece1mask_seq = autograd.Variable(torch.from_numpy(cur_input['piece1Mask'].astype('float32')).cuda())
-        piece2mask_seq = autograd.Variable(torch.from_numpy(cur_input['piece2Mask'].astype('float32')).cuda())
-        piece3mask_seq = autograd.Variable(torch.from_numpy(cur_input['piece3Mask'].astype('float32')).cuda())
-
-        if model_id in [1]:
-            outputs = model(words_seq, words_mask, arg1_lin_dist, arg2_lin_dist)
-        elif model_id == 2:
-            outputs = model(words_seq, words_mask, arg1_lin_dist, arg2_lin_dist,
-                            piece1mask_seq, piece2mask_seq, piece3mask_seq)
-        elif model_id in [3]:
-            outputs = model(words_seq, words_mask, arg1_lin_dist, arg2_lin_dist,
-                            piece1mask_seq, piece2mask_seq, piece3mask_seq, arg1, arg2)
-        elif model_id in [4]:
-            outputs = model(words_seq, words_mask, arg1_lin_dist, arg2_lin_dist,
-                            piece1mask_seq, piece2mask_seq, piece3mask_seq)
-
-        outputs = F.softmax(outputs, dim=-1)
-        preds += list(outputs.data.cpu().numpy())
+    with torch.no_grad():
+        for batch_idx, cur_input in iter_eval_batches(samples, model_id, sort_by_len):
+            outputs = get_model_outputs(infer_model, model_id, cur_input)
+            outputs = F.softmax(outputs, dim=-1)
+            if labels_only:
+                conf, labels = outputs.max(dim=-1)
+                pred_labels[batch_idx] = labels.cpu().numpy()
+                pred_conf[batch_idx] = conf.cpu().numpy()
+            else:
+                preds[batch_idx] = outputs.cpu().numpy()
     model.zero_grad()
+    if labels_only:
+        return pred_labels, pred_conf
     return preds
 
 
+def predict_ensemble(samples, models, model_id, member_preds=None):
+    """
+    Returns the summed class probabilities of the member models. Every batch is collated once and run through
+    all the members, and the member outputs are added up batch by batch. The outputs of each member are also
+    written to the [N, num_classes] arrays of member_preds when given.
+    """
+    custom_print('Pred size:', len(samples))
+    preds = np.zeros((len(samples), len(relation_cls_label_map)), dtype=np.float32)
+    for model in models:
+        model.eval()
+    infer_models = [get_inference_model(model) for model in models]
+    np.random.seed(random_seed)
+    torch.cuda.manual_seed(random_seed)
+    random.seed(random_seed)
+    with torch.no_grad():
+        for batch_idx, cur_input in iter_eval_batches(samples, model_id):
+            batch_preds = None
+            for member_idx, infer_model in enumerate(infer_models):
+                outputs = F.softmax(get_model_outputs(infer_model, model_id, cur_input), dim=-1).cpu().numpy()
+                if member_preds is not None:
+                    member_preds[member_idx][batch_idx] = outputs
+                if batch_preds is None:
+                    batch_preds = outputs
+                else:
+                    batch_preds += outputs
+            preds[batch_idx] = batch_preds
+    return preds
+
+
+def load_model(model_folder, model_id):
+    model = get_model(model_id)
+    custom_print(model)
+    model.to(device)
+    model.load_state_dict(torch.load(os.path.join(model_folder, 'model.h5py'), map_location=device))
+    return model
+
+
+def export_onnx(model, model_id, samples, model_folder):
+    """
+    Writes the model to model.onnx in model_folder with dynamic batch and sequence axes, along with
+    onnx_meta.json that holds the model id, the vocabulary, the relation labels and the preprocessing settings
+    """
+    model.eval()
+    input_names = get_model_input_names(model_id)
+    batch_bounds = get_batch_bounds(len(samples), eval_batch_size)
+    cur_input = get_batch_tensors(get_batch_data(samples[batch_bounds[0][0]:batch_bounds[0][1]]))
+    dynamic_axes = dict((name, {0: 'batch', 1: 'seq'}) for name in input_names)
+    for name in ['arg1', 'arg2']:
+        if name in dynamic_axes:
+            dynamic_axes[name] = {0: 'batch'}
+    dynamic_axes['logits'] = {0: 'batch'}
+    export_args = dict()
+    # pytorch 2 exports with dynamo by default, the models are exported by tracing as in pytorch 1.x
+    if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+        export_args['dynamo'] = False
+    with torch.no_grad():
+        torch.onnx.export(model, tuple(cur_input[name] for name in input_names),
+                          os.path.join(model_folder, 'model.onnx'), input_names=input_names,
+                          output_names=['logits'], dynamic_axes=dynamic_axes, opset_version=12, **export_args)
+    meta = OrderedDict()
+    meta['model_id'] = model_id
+    meta['relations'] = list(relation_cls_label_map)
+    meta['max_sent_len'] = max_sent_len
+    meta['ctx_len'] = ctx_len
+    meta['max_word_arg_head_dist'] = max_word_arg_head_dist
+    meta['vocab'] = word_vocab
+    with open(os.path.join(model_folder, 'onnx_meta.json'), 'w') as f:
+        json.dump(meta, f)
+
+
+def load_onnx_meta(model_folder):
+    with open(os.path.join(model_folder, 'onnx_meta.json')) as f:
+        return json.load(f, object_pairs_hook=OrderedDict)
+
+
+def load_model_vocab(model_folder):
+    """
+    Returns the vocabulary of a trained model folder, taken from onnx_meta.json for the onnx inference_backend
+    so that an exported model is served without its checkpoint files
+    """
+    if inference_backend == 'onnx':
+        return load_onnx_meta(model_folder)['vocab']
+    return load_vocab(os.path.join(model_folder, 'vocab.pkl'))
+
+
+def load_onnx_session(model_folder):
+    if onnxruntime is None:
+        raise ImportError('inference_backend onnx needs onnxruntime')
+    options = onnxruntime.SessionOptions()
+    if cpu_threads > 0:
+        options.intra_op_num_threads = cpu_threads
+    if cpu_interop_threads > 0:
+        options.inter_op_num_threads = cpu_interop_threads
+    return onnxruntime.InferenceSession(os.path.join(model_folder, 'model.onnx'), options,
+                                        providers=['CPUExecutionProvider'])
+
+
+def load_inference_model(model_folder, model_id):
+    """
+    Returns the model of a trained model folder for the inference_backend, an ONNX Runtime session of its
+    exported model.onnx for onnx and the pytorch model otherwise
+    """
+    if inference_backend == 'onnx':
+        return load_onnx_session(model_folder)
+    return load_model(model_folder, model_id)
+
+
+def predict_onnx(samples, session, model_id, sort_by_len=None):
+    """
+    Returns the [N, num_classes] float32 class probabilities of the samples from an ONNX Runtime session
+    """
+    preds = np.zeros((len(samples), len(relation_cls_label_map)), dtype=np.float32)
+    # the exporter drops the inputs a model does not use, such as the piece masks of EA
+    input_names = [session_input.name for session_input in session.get_inputs()]
+    for batch_idx, cur_input in iter_eval_batches(samples, model_id, sort_by_len):
+        feed = dict((name, cur_input[name].cpu().numpy()) for name in input_names)
+        logits = session.run(['logits'], feed)[0]
+        probs = np.exp(logits - logits.max(axis=1, keepdims=True))
+        preds[batch_idx] = probs / probs.sum(axis=1, keepdims=True)
+    return preds
+
+
+def get_pred_cache_file(model_folder, data_file, model_id, backend='torch'):
+    """
+    Returns the prediction cache file of a checkpoint on a dataset, keyed by the checkpoint and vocabulary
+    content (model.onnx and onnx_meta.json for the onnx backend), the compiled dataset and the inference
+    settings, or None without use_pred_cache
+    """
+    if not use_pred_cache:
+        return None
+    hasher = hashlib.sha1()
+    if backend == 'onnx':
+        get_file_hash(os.path.join(model_folder, 'model.onnx'), hasher)
+        get_file_hash(os.path.join(model_folder, 'onnx_meta.json'), hasher)
+    else:
+        get_file_hash(os.path.join(model_folder, 'model.h5py'), hasher)
+        get_file_hash(os.path.join(model_folder, 'vocab.pkl'), hasher)
+    params = [os.path.basename(get_data_cache_path(data_file)), model_id, get_eval_batch_size(model_id),
+              is_sorted_eval(model_id), np.dtype(pred_cache_dtype).name, is_packed_gru(False),
+              compile_models and len_buckets, backend]
+    hasher.update(json.dumps(params).encode('utf-8'))
+    file_name = os.path.splitext(os.path.basename(data_file))[0]
+    return os.path.join(pred_cache_dir, file_name + '-' + hasher.hexdigest()[:16] + '.npy')
+
+
+def load_pred_cache(cache_file):
+    """
+    Returns the memory-mapped cached predictions, or None when they were not cached yet
+    """
+    if cache_file is None or not os.path.exists(cache_file):
+        return None
+    custom_print('cached predictions:', cache_file)
+    return np.load(cache_file, mmap_mode='r')
+
+
+def save_pred_cache(cache_file, preds):
+    """
+    Caches the predictions as pred_cache_dtype and returns them as cached, so that a run gives the same
+    results whether or not its predictions were cached
+    """
+    if cache_file is None:
+        return preds
+    preds = preds.astype(pred_cache_dtype, copy=False)
+    if not is_writable_dir(pred_cache_dir):
+        return preds
+    tmp_file = cache_file + '.tmp' + str(os.getpid())
+    with open(tmp_file, 'wb') as f:
+        np.save(f, preds)
+    os.rename(tmp_file, cache_file)
+    return preds
+
+
+def get_vocab_groups(member_folders):
+    """
+    Groups the ensemble member folders by the content of their vocab.pkl, so that the data is indexed once
+    per distinct vocabulary
+    """
+    vocab_groups = OrderedDict()
+    for member_folder in member_folders:
+        hasher = hashlib.sha1()
+        get_file_hash(os.path.join(member_folder, 'vocab.pkl'), hasher)
+        vocab_groups.setdefault(hasher.hexdigest(), []).append(member_folder)
+    return list(vocab_groups.values())
+
+
+model_input_names = ['words', 'wordsMask', 'arg1LinDist', 'arg2LinDist', 'piece1Mask', 'piece2Mask', 'piece3Mask',
+                     'arg1', 'arg2']
+
+
+def get_model_input_names(model_id):
+    """
+    Returns the batch inputs of a model, in the order of its forward arguments
+    """
+    if model_id in [1]:
+        return model_input_names[:4]
+    elif model_id in [2, 4]:
+        return model_input_names[:7]
+    return model_input_names
+
+
+def get_model_outputs(model, model_id, cur_input, is_training=False):
+    inputs = [cur_input[name] for name in get_model_input_names(model_id)]
+    if is_training:
+        return model(*inputs, is_training=True)
+    return model(*inputs)
+
+
+def setup_device():
+    """
+    Applies the CPU thread settings, cpu_threads intra-op and cpu_interop_threads inter-op threads (0 keeps the
+    torch defaults), and with pin_cpu_threads restricts the process to the first cpu_threads allowed cores
+    """
+    if pin_cpu_threads and hasattr(os, 'sched_setaffinity'):
+        cores = sorted(os.sched_getaffinity(0))
+        if cpu_threads > 0:
+            cores = cores[:cpu_threads]
+        os.sched_setaffinity(0, cores)
+    if cpu_threads > 0:
+        torch.set_num_threads(cpu_threads)
+    if cpu_interop_threads > 0:
+        torch.set_num_interop_threads(cpu_interop_threads)
+
+
+def benchmark_model(samples, model_id):
+    """
+    Returns the inference throughput in sentences per second and latency in milliseconds per batch of a
+    randomly initialized model, timed after a warm-up pass that also compiles every bucket shape
+    """
+    model = get_model(model_id)
+    model.to(device)
+    predict(samples, model, model_id)
+    start_time = datetime.datetime.now()
+    predict(samples, model, model_id)
+    seconds = (datetime.datetime.now() - start_time).total_seconds()
+    batch_count = len(get_batch_bounds(len(samples), get_eval_batch_size(model_id)))
+    return len(samples) / seconds, 1000.0 * seconds / batch_count
+
+
+def get_filter_mask(preds, labels, is_ignore_rel, k):
+    """
+    Returns the keep-mask of the self-ensemble noise filter. A sample of an ignored relation is kept when its
+    label is the top teacher prediction, any other sample when its label is among the top k predictions.
+    """
+    _, topk = preds.topk(k)
+    is_label = topk == labels.clamp(min=0).unsqueeze(1)
+    keep_mask = torch.where(is_ignore_rel[labels.clamp(min=0)], is_label[:, 0], is_label.any(dim=1))
+    # samples of relations unknown to relations.txt are never kept
+    return keep_mask & (labels >= 0)
+
+
 def rampup(step_idx, max_rampup_steps, alpha):
     p = 1.0 - min(step_idx, max_rampup_steps) / max_rampup_steps
     return np.exp(-p * p * 5.0) * alpha
 
 
-def update_teacher(model, teacher, step_idx, max_rampup_steps, alpha):
+def update_teacher(model_params, teacher_params, step_idx, max_rampup_steps, alpha):
     # Use the true average until the exponential average is more correct
     # alpha = min(1 - 1 / (epoch_idx + 1), alpha)
-    alpha = rampup(step_idx, max_rampup_steps, alpha)
-    for teacher_param, param in zip(teacher.parameters(), model.parameters()):
-        teacher_param.data.mul_(alpha).add_(param.data, alpha=1 - alpha)
+    alpha = float(rampup(step_idx, max_rampup_steps, alpha))
+    # one multi-tensor kernel per op over all the parameters instead of two small ops per parameter
+    with torch.no_grad():
+        torch._foreach_mul_(teacher_params, alpha)
+        torch._foreach_add_(teacher_params, model_params, alpha=1 - alpha)
 
 
 def train_mean_teacher_model(model_id, train_samples, dev_samples, test_samples, best_model_file):
     batch_count = int(math.ceil(len(train_samples)/batch_size))
     max_rampup_steps = max_rampup_epochs * batch_count
-    move_last_batch = False
-    if len(train_samples) - batch_size * (batch_count - 1) == 1:
-        move_last_batch = True
-        batch_count -= 1
     # custom_print(batch_count)
     model = get_model(model_id)
     teacher = copy.deepcopy(model)
 
     custom_print(model)
-    if torch.cuda.is_available():
-        model.cuda()
-        teacher.cuda()
+    model.to(device)
+    teacher.to(device)
+
+    model_params = list(model.parameters())
+    teacher_params = list(teacher.parameters())
+    for teacher_param in teacher_params:
+        teacher_param.requires_grad_(False)
 
     rel_loss_func = nn.NLLLoss()
     consistency_loss = nn.MSELoss(reduction='sum')
@@ -920,12 +1847,21 @@ def train_mean_teacher_model(model_id, train_samples, dev_samples, test_samples,
     best_epoch_idx = -1
     best_epoch_seed = -1
     # target_dct = OrderedDict()
-    cur_shuffled_train_data = shuffle_data(train_samples)
+    cur_train_pos, batch_bounds = get_train_batches(train_samples)
+    batch_count = len(batch_bounds)
+    if batch_tokens > 0:
+        max_rampup_steps = max_rampup_epochs * batch_count
+    if enable_filtering:
+        train_labels = torch.LongTensor([d.Label for d in train_samples])
+        is_ignore_rel = torch.BoolTensor([rel_name in ignore_rel_list for rel_name in relation_cls_label_map])
+    if enable_filtering and incremental_filtering:
+        # the teacher probabilities of every training sample, taken from the training forwards
+        teacher_preds = torch.zeros(len(train_samples), len(relation_cls_label_map), device=device)
     global_step = 1
     for epoch_idx in range(0, num_epoch):
         custom_print('Epoch:', epoch_idx + 1)
         custom_print('\n')
-        custom_print('Training data size:', len(cur_shuffled_train_data))
+        custom_print('Training data size:', len(cur_train_pos))
         # wt = rampup(epoch_idx)
         model.train()
         teacher.train()
@@ -936,63 +1872,31 @@ def train_mean_teacher_model(model_id, train_samples, dev_samples, test_samples,
         random.seed(cur_seed)
         start_time = datetime.datetime.now()
         train_loss_val = 0.0
-        for batch_idx in tqdm(range(0, batch_count)):
-            batch_start = batch_idx * batch_size
-            batch_end = min(len(cur_shuffled_train_data), batch_start + batch_size)
-            if batch_idx == batch_count - 1 and move_last_batch:
-                batch_end = len(cur_shuffled_train_data)
-
-            cur_batch = cur_shuffled_train_data[batch_start:batch_end]
-            cur_seq_len, cur_input, cur_target = get_batch_data(cur_batch, True)
-
-            words_seq = autograd.Variable(torch.from_numpy(cur_input['words'].astype('long')).cuda())
-            words_mask = autograd.Variable(torch.from_numpy(cur_input['wordsMask'].astype('float32')).cuda())
-            arg1_lin_dist = autograd.Variable(torch.from_numpy(cur_input['arg1LinDist'].astype('long')).cuda())
-            arg2_lin_dist = autograd.Variable(torch.from_numpy(cur_input['arg2LinDist'].astype('long')).cuda())
-
-            arg1 = autograd.Variable(torch.from_numpy(cur_input['arg1'].astype('long')).cuda())
-            arg2 = autograd.Variable(torch.from_numpy(cur_input['arg2'].astype('long')).cuda())
-
-            piece1mask_seq = autograd.Variable(torch.from_numpy(cur_input['piece1Mask'].astype('float32')).cuda())
-            piece2mask_seq = autograd.Variable(torch.from_numpy(cur_input['piece2Mask'].astype('float32')).cuda())
-            piece3mask_seq = autograd.Variable(torch.from_numpy(cur_input['piece3Mask'].astype('float32')).cuda())
-
-            target_vec = torch.from_numpy(cur_target['relation'].astype('float32'))
-            _, target = target_vec.topk(1)
-
-            target = autograd.Variable(target.cuda())
-
-            if model_id in [1]:
-                outputs = model(words_seq, words_mask, arg1_lin_dist, arg2_lin_dist, True)
-                teacher_outputs = teacher(words_seq, words_mask, arg1_lin_dist, arg2_lin_dist, True)
-            elif model_id == 2:
-                outputs = model(words_seq, words_mask, arg1_lin_dist, arg2_lin_dist,
-                                piece1mask_seq, piece2mask_seq, piece3mask_seq, True)
-                teacher_outputs = teacher(words_seq, words_mask, arg1_lin_dist, arg2_lin_dist,
-                                piece1mask_seq, piece2mask_seq, piece3mask_seq, True)
-            elif model_id in [3]:
-                outputs = model(words_seq, words_mask, arg1_lin_dist, arg2_lin_dist,
-                                piece1mask_seq, piece2mask_seq, piece3mask_seq, arg1, arg2, True)
-                teacher_outputs = teacher(words_seq, words_mask, arg1_lin_dist, arg2_lin_dist,
-                                piece1mask_seq, piece2mask_seq, piece3mask_seq, arg1, arg2, True)
-            elif model_id in [4]:
-                outputs = model(words_seq, words_mask, arg1_lin_dist, arg2_lin_dist,
-                                piece1mask_seq, piece2mask_seq, piece3mask_seq, True)
-                teacher_outputs = teacher(words_seq, words_mask, arg1_lin_dist, arg2_lin_dist,
-                                piece1mask_seq, piece2mask_seq, piece3mask_seq, True)
+        if enable_filtering and incremental_filtering:
+            is_seen = np.zeros(len(train_samples), dtype=bool)
+            is_seen[cur_train_pos] = True
+        train_batches = iter_batches(train_samples, batch_bounds, cur_train_pos)
+        for (batch_start, batch_end), cur_input in tqdm(zip(batch_bounds, train_batches), total=batch_count):
+            target = cur_input['relation']
+            outputs = get_model_outputs(model, model_id, cur_input, is_training=True)
+            # the teacher outputs are only targets, so its forward builds no graph
+            with torch.no_grad():
+                teacher_outputs = get_model_outputs(teacher, model_id, cur_input)
 
             log_softmax_out = F.log_softmax(outputs, dim=-1)
             softmax_out = F.softmax(outputs, dim=-1)
             teacher_softmax_out = F.softmax(teacher_outputs, dim=-1)
-            teacher_softmax_out = autograd.Variable(teacher_softmax_out.detach().data, requires_grad=False)
+            if enable_filtering and incremental_filtering:
+                batch_pos = torch.from_numpy(cur_train_pos[batch_start:batch_end]).to(teacher_preds.device)
+                teacher_preds.index_copy_(0, batch_pos, teacher_softmax_out.data)
             loss = rel_loss_func(log_softmax_out, target.view(-1)) + \
                    consistency_loss(softmax_out, teacher_softmax_out) / softmax_out.size()[0]
             loss.backward()
-            torch.nn.utils.clip_grad_norm_(model.parameters(), 10.0)
+            torch.nn.utils.clip_grad_norm_(model_params, 10.0)
             optimizer.step()
             train_loss_val += loss.item()
             model.zero_grad()
-            update_teacher(model, teacher, global_step, max_rampup_steps, alpha)
+            update_teacher(model_params, teacher_params, global_step, max_rampup_steps, alpha)
             global_step += 1
 
         train_loss_val /= batch_count
@@ -1036,28 +1940,23 @@ def train_mean_teacher_model(model_id, train_samples, dev_samples, test_samples,
             if enable_filtering:
                 custom_print('\nFiltering\n')
                 torch.cuda.manual_seed(random_seed)
-                train_preds = predict(train_samples, teacher, model_id)
-                train_preds = np.array(train_preds)
-                train_preds_tensor = torch.from_numpy(train_preds)
-
-                _, topk = train_preds_tensor.topk(top_k)
-                filtered_data = []
-                for i in range(0, len(train_samples)):
-                    org_rel_name = train_samples[i].RelationName
-                    org_rel_idx = relation_cls_label_map[org_rel_name]
-                    if org_rel_name in ignore_rel_list:
-                        if org_rel_idx == topk[i][0]:
-                            filtered_data.append(train_samples[i])
-                    else:
-                        if org_rel_idx in topk[i]:
-                            filtered_data.append(train_samples[i])
-
-                cur_shuffled_train_data = shuffle_data(filtered_data)
-                batch_count = int(math.ceil(len(cur_shuffled_train_data) / batch_size))
-                move_last_batch = False
-                if len(cur_shuffled_train_data) - batch_size * (batch_count - 1) == 1:
-                    move_last_batch = True
-                    batch_count -= 1
+                if incremental_filtering:
+                    # only the samples filtered out of this epoch need a teacher forward
+                    refresh_pos = np.nonzero(~is_seen)[0]
+                    custom_print('Refreshed samples:', len(refresh_pos))
+                    if len(refresh_pos) > 0:
+                        refresh_preds = predict([train_samples[idx] for idx in refresh_pos], teacher, model_id)
+                        teacher_preds.index_copy_(0, torch.from_numpy(refresh_pos).to(teacher_preds.device),
+                                                  torch.from_numpy(refresh_preds).to(teacher_preds.device))
+                    train_preds_tensor = teacher_preds.cpu()
+                else:
+                    # in order of length, as the in-place sort of the former shuffle_data left the samples
+                    train_preds = predict(train_samples, teacher, model_id, sort_by_len=True)
+                    train_preds_tensor = torch.from_numpy(train_preds)
+
+                keep_mask = get_filter_mask(train_preds_tensor, train_labels, is_ignore_rel, top_k)
+                cur_train_pos, batch_bounds = get_train_batches(train_samples, np.nonzero(keep_mask.numpy())[0])
+                batch_count = len(batch_bounds)
 
         custom_print('\n\n')
 
@@ -1067,18 +1966,10 @@ def train_mean_teacher_model(model_id, train_samples, dev_samples, test_samples,
 
 
 def torch_train(model_id, train_samples, dev_samples, test_samples, best_model_file):
-    train_size = len(train_samples)
-    batch_count = int(math.ceil(train_size/batch_size))
-    move_last_batch = False
-    if len(train_samples) - batch_size * (batch_count - 1) == 1:
-        move_last_batch = True
-        batch_count -= 1
-    custom_print(batch_count)
     model = get_model(model_id)
 
     custom_print(model)
-    if torch.cuda.is_available():
-        model.cuda()
+    model.to(device)
 
     rel_loss_func = nn.NLLLoss()
     optimizer = optim.Adagrad(model.parameters())
@@ -1094,46 +1985,14 @@ def torch_train(model_id, train_samples, dev_samples, test_samples, best_model_f
         np.random.seed(cur_seed)
         torch.cuda.manual_seed(cur_seed)
         random.seed(cur_seed)
-        cur_shuffled_train_data = shuffle_data(train_samples)
+        cur_train_pos, batch_bounds = get_train_batches(train_samples)
+        batch_count = len(batch_bounds)
+        custom_print('Batch count:', batch_count)
         start_time = datetime.datetime.now()
         train_loss_val = 0.0
-        for batch_idx in tqdm(range(0, batch_count)):
-            batch_start = batch_idx * batch_size
-            batch_end = min(len(cur_shuffled_train_data), batch_start + batch_size)
-            if batch_idx == batch_count - 1 and move_last_batch:
-                batch_end = len(cur_shuffled_train_data)
-
-            cur_batch = cur_shuffled_train_data[batch_start:batch_end]
-            cur_seq_len, cur_input, cur_target = get_batch_data(cur_batch, True)
-
-            words_seq = autograd.Variable(torch.from_numpy(cur_input['words'].astype('long')).cuda())
-            words_mask = autograd.Variable(torch.from_numpy(cur_input['wordsMask'].astype('float32')).cuda())
-            arg1_lin_dist = autograd.Variable(torch.from_numpy(cur_input['arg1LinDist'].astype('long')).cuda())
-            arg2_lin_dist = autograd.Variable(torch.from_numpy(cur_input['arg2LinDist'].astype('long')).cuda())
-
-            arg1 = autograd.Variable(torch.from_numpy(cur_input['arg1'].astype('long')).cuda())
-            arg2 = autograd.Variable(torch.from_numpy(cur_input['arg2'].astype('long')).cuda())
-
-            piece1mask_seq = autograd.Variable(torch.from_numpy(cur_input['piece1Mask'].astype('float32')).cuda())
-            piece2mask_seq = autograd.Variable(torch.from_numpy(cur_input['piece2Mask'].astype('float32')).cuda())
-            piece3mask_seq = autograd.Variable(torch.from_numpy(cur_input['piece3Mask'].astype('float32')).cuda())
-
-            target_vec = torch.from_numpy(cur_target['relation'].astype('float32'))
-            _, target = target_vec.topk(1)
-
-            target = autograd.Variable(target.cuda())
-
-            if model_id in [1]:
-                outputs = model(words_seq, words_mask, arg1_lin_dist, arg2_lin_dist, True)
-            elif model_id == 2:
-                outputs = model(words_seq, words_mask, arg1_lin_dist, arg2_lin_dist,
-                                piece1mask_seq, piece2mask_seq, piece3mask_seq, True)
-            elif model_id in [3]:
-                outputs = model(words_seq, words_mask, arg1_lin_dist, arg2_lin_dist,
-                                piece1mask_seq, piece2mask_seq, piece3mask_seq, arg1, arg2, True)
-            elif model_id in [4]:
-                outputs = model(words_seq, words_mask, arg1_lin_dist, arg2_lin_dist,
-                                piece1mask_seq, piece2mask_seq, piece3mask_seq, True)
+        for cur_input in tqdm(iter_batches(train_samples, batch_bounds, cur_train_pos), total=batch_count):
+            target = cur_input['relation']
+            outputs = get_model_outputs(model, model_id, cur_input, is_training=True)
             log_softmax_out = F.log_softmax(outputs, dim=-1)
             loss = rel_loss_func(log_softmax_out, target.view(-1))
             loss.backward()
@@ -1204,12 +2063,20 @@ if __name__ == "__main__":
     alpha = 0.9
     max_rampup_epochs = 5
     enable_filtering = True
+    incremental_filtering = False
     top_k = 3
 
     if not os.path.exists(trg_data_folder):
         os.mkdir(trg_data_folder)
 
     batch_size = 50
+    eval_batch_size = 500
+    # CNN, EA and the unpacked BGWA GRU depend on the batch padding, so with legacy_eval_padding they are
+    # evaluated as before, BGWA unpacked and all three in file order batch_size batches
+    legacy_eval_padding = True
+    sort_eval_batches = True
+    batch_tokens = 2500
+    bucket_width = 5
     num_epoch = 50
     max_sent_len = 100
     dim_size = 50
@@ -1225,16 +2092,54 @@ if __name__ == "__main__":
     ctx_len = 5
     early_stop_cnt = 5
     lstm_direction = 2
+    # packs the BGWA GRU input in training, and in evaluation as well without legacy_eval_padding
+    pack_gru_input = True
     ignore_rel_list = ['None', 'NA', 'Other']
     is_type_available = False
+    # the compiled data, embedding, prediction and torch.compile caches, skipped when it is not writable
+    cache_root = src_data_folder
+    use_data_cache = True
+    data_cache_dir = os.path.join(cache_root, 'compiled')
+    data_cache_version = 1
+    data_chunk_size = 10000
+    data_workers = os.cpu_count() or 1
+    use_embed_cache = True
+    batch_workers = 2
+    batch_prefetch = 4
+    pin_batch_memory = True
+    compile_models = False
+    inference_backend = 'torch'
+    len_buckets = [16, 32, 64, 128]
+    use_pred_cache = True
+    pred_cache_dir = os.path.join(cache_root, 'predictions')
+    pred_cache_dtype = np.float32
+    compile_cache_dir = os.path.join(data_cache_dir, 'inductor')
+
+    # use_cpu runs every job mode on the CPU, also on a host with a GPU
+    use_cpu = False
+    device = torch.device('cuda' if torch.cuda.is_available() and not use_cpu else 'cpu')
+    cpu_threads = 0
+    cpu_interop_threads = 0
+    pin_cpu_threads = False
+    setup_device()
 
-    relation_cls_label_map, rel_label_cls_map = get_class_label_map(os.path.join(src_data_folder, 'relations.txt'))
     max_word_arg_head_dist = 30
+    if inference_backend == 'onnx' and job_mode in ['test', 'predict']:
+        # an exported model is served with the relations and preprocessing settings it was exported with
+        onnx_meta = load_onnx_meta(trg_data_folder)
+        relation_cls_label_map, rel_label_cls_map = get_label_maps(onnx_meta['relations'])
+        max_sent_len = onnx_meta['max_sent_len']
+        ctx_len = onnx_meta['ctx_len']
+        max_word_arg_head_dist = onnx_meta['max_word_arg_head_dist']
+    else:
+        relation_cls_label_map, rel_label_cls_map = get_class_label_map(os.path.join(src_data_folder,
+                                                                                     'relations.txt'))
     dist_vocab_size = 2 * max_word_arg_head_dist + 1
 
-    QASample = recordclass("QASample", "UID Id Len Text Arg1 Arg2 Words WordsMask WordsArg1Dist WordsArg2Dist "
-                                       "WordsEntIndicator Arg1Mask Arg2Mask Piece1Mask Piece2Mask Piece3Mask "
-                                       "RelationName")
+    QASample = recordclass("QASample", "UID Id Len Text Arg1 Arg2 Words Arg1Start Arg1End Arg2Start Arg2End "
+                                       "Label RelationName WordIds Arg1Id Arg2Id")
+    data_words = list()
+    data_word_idx = dict()
 
     # train a model
     if job_mode == 'train':
@@ -1265,6 +2170,7 @@ if __name__ == "__main__":
         vocab_file_name = os.path.join(trg_data_folder, 'vocab.pkl')
         all_data = train_data + dev_data + test_data
         word_vocab, word_embed_matrix = build_vocab(train_data, dev_data, test_data, vocab_file_name, embedding_file)
+        index_data(all_data)
 
         custom_print('vocab size:', len(word_vocab))
 
@@ -1275,32 +2181,40 @@ if __name__ == "__main__":
             torch_train(model_name, train_data, dev_data, test_data, best_model_file_name)
         logger.close()
 
+    if job_mode == 'check_data':
+        logger = open(os.path.join(trg_data_folder, 'check_data.log'), 'w')
+        custom_print(sys.argv)
+        custom_print('workers:', data_workers)
+        check_parallel_data(os.path.join(src_data_folder, 'train.json'), is_training_data=True)
+        check_parallel_data(os.path.join(src_data_folder, 'dev.json'))
+        check_parallel_data(os.path.join(src_data_folder, 'test.json'))
+        logger.close()
+
     if job_mode == 'test':
         logger = open(os.path.join(trg_data_folder, 'test.log'), 'w')
         custom_print(sys.argv)
         custom_print("loading word vectors......")
-        vocab_file_name = os.path.join(trg_data_folder, 'vocab.pkl')
-        word_vocab = load_vocab(vocab_file_name)
+        word_vocab = load_model_vocab(trg_data_folder)
 
         word_embed_matrix = np.zeros((len(word_vocab), word_embed_dim), dtype=np.float32)
         custom_print('vocab size:', len(word_vocab))
 
         custom_print('seed:', random_seed)
-        model_file = os.path.join(trg_data_folder, 'model.h5py')
-
-        best_model = get_model(model_name)
-        custom_print(best_model)
-        if torch.cuda.is_available():
-            best_model.cuda()
-        best_model.load_state_dict(torch.load(model_file))
+        # the model is loaded only when some predictions are not cached
+        best_model = None
 
         # prediction on dev data
 
         dev_file = os.path.join(src_data_folder, 'dev.json')
         dev_data = read_data(dev_file)
+        index_data(dev_data)
         custom_print('Dev data size:', len(dev_data))
-        torch.cuda.manual_seed(random_seed)
-        dev_preds = predict(dev_data, best_model, model_name)
+        dev_cache_file = get_pred_cache_file(trg_data_folder, dev_file, model_name, inference_backend)
+        dev_preds = load_pred_cache(dev_cache_file)
+        if dev_preds is None:
+            best_model = load_inference_model(trg_data_folder, model_name)
+            torch.cuda.manual_seed(random_seed)
+            dev_preds = save_pred_cache(dev_cache_file, predict(dev_data, best_model, model_name))
 
         custom_print('\nDev Results')
         pred_pos, gt_pos, correct_pos = get_F1(dev_data, dev_preds)
@@ -1329,11 +2243,18 @@ if __name__ == "__main__":
             custom_print('\n\n\nTest Results:', file_name)
             test_input_file = os.path.join(src_data_folder, file_name + '.json')
             test_data = read_data(test_input_file)
+            index_data(test_data)
             out_file_name = os.path.join(trg_data_folder, file_name + '-output.json')
 
             custom_print('Test data size:', len(test_data))
-            torch.cuda.manual_seed(random_seed)
-            test_preds = predict(test_data, best_model, model_name)
+            test_cache_file = get_pred_cache_file(trg_data_folder, test_input_file, model_name,
+                                                  inference_backend)
+            test_preds = load_pred_cache(test_cache_file)
+            if test_preds is None:
+                if best_model is None:
+                    best_model = load_inference_model(trg_data_folder, model_name)
+                torch.cuda.manual_seed(random_seed)
+                test_preds = save_pred_cache(test_cache_file, predict(test_data, best_model, model_name))
 
             pred_pos, gt_pos, correct_pos = get_F1(test_data, test_preds)
             custom_print(pred_pos, '\t', gt_pos, '\t', correct_pos)
@@ -1354,91 +2275,114 @@ if __name__ == "__main__":
             print()
         logger.close()
 
-    if job_mode == 'ensemble':
-        output_folder = trg_data_folder
-        logger = open(os.path.join(output_folder, 'test.log'), 'w')
+    if job_mode == 'predict':
+        logger = open(os.path.join(trg_data_folder, 'predict.log'), 'w')
         custom_print(sys.argv)
-        trg_data_folder = sys.argv[5]
-        custom_print("loading word vectors......")
-        vocab_file_name = os.path.join(trg_data_folder, 'vocab.pkl')
-        word_vocab = load_vocab(vocab_file_name)
-
+        word_vocab = load_model_vocab(trg_data_folder)
         word_embed_matrix = np.zeros((len(word_vocab), word_embed_dim), dtype=np.float32)
         custom_print('vocab size:', len(word_vocab))
+        input_file = sys.argv[5]
+        threshold = float(sys.argv[6]) if len(sys.argv) > 6 else 0.0
+        out_file_name = os.path.join(trg_data_folder,
+                                     os.path.splitext(os.path.basename(input_file))[0] + '-output.json')
+        best_model = load_inference_model(trg_data_folder, model_name)
+        custom_print('predicted samples:', predict_file(input_file, best_model, model_name, out_file_name, threshold))
+        custom_print('output:', out_file_name)
+        logger.close()
 
-        custom_print('seed:', random_seed)
-        model_file = os.path.join(trg_data_folder, 'model.h5py')
-
-        best_model = get_model(model_name)
-        custom_print(best_model)
-        if torch.cuda.is_available():
-            best_model.cuda()
-        best_model.load_state_dict(torch.load(model_file))
+    if job_mode == 'export':
+        logger = open(os.path.join(trg_data_folder, 'export.log'), 'w')
+        custom_print(sys.argv)
+        word_vocab = load_vocab(os.path.join(trg_data_folder, 'vocab.pkl'))
+        word_embed_matrix = np.zeros((len(word_vocab), word_embed_dim), dtype=np.float32)
+        custom_print('vocab size:', len(word_vocab))
+        dev_data = read_data(os.path.join(src_data_folder, 'dev.json'))
+        index_data(dev_data)
+        best_model = load_model(trg_data_folder, model_name)
+        export_onnx(best_model, model_name, dev_data, trg_data_folder)
+        custom_print('exported:', os.path.join(trg_data_folder, 'model.onnx'))
+        if onnxruntime is not None:
+            dev_preds = predict(dev_data, best_model, model_name)
+            onnx_dev_preds = predict(dev_data, load_onnx_session(trg_data_folder), model_name)
+            custom_print('max dev probability difference:', np.abs(dev_preds - onnx_dev_preds).max())
+        logger.close()
 
-        # prediction on dev data
+    if job_mode == 'benchmark':
+        logger = open(os.path.join(trg_data_folder, 'benchmark.log'), 'w')
+        custom_print(sys.argv)
+        custom_print('device:', device)
+        custom_print('threads:', torch.get_num_threads(), torch.get_num_interop_threads())
+        dev_data = read_data(os.path.join(src_data_folder, 'dev.json'))
+        custom_print('Dev data size:', len(dev_data))
+        # the speed does not depend on the embeddings, so zero vectors of the dev words will do
+        word_vocab = OrderedDict([('<PAD>', 0), ('<UNK>', 1)])
+        for word in data_words:
+            word_vocab.setdefault(word, len(word_vocab))
+        word_embed_matrix = np.zeros((len(word_vocab), word_embed_dim), dtype=np.float32)
+        index_data(dev_data)
+        bench_compile = [False, True] if hasattr(torch, 'compile') else [False]
+        for bench_model_id in [1, 2, 3, 4]:
+            for compile_models in bench_compile:
+                sent_per_sec, batch_ms = benchmark_model(dev_data, bench_model_id)
+                custom_print('model_id:', bench_model_id, 'compiled:', compile_models,
+                             'sentences/second:', round(sent_per_sec, 1), 'ms/batch:', round(batch_ms, 1))
+        logger.close()
 
-        custom_print('prediction with model: 1')
-        custom_print(trg_data_folder)
+    if job_mode == 'ensemble':
+        output_folder = trg_data_folder
+        logger = open(os.path.join(output_folder, 'test.log'), 'w')
+        custom_print(sys.argv)
+        member_folders = sys.argv[5:]
+        custom_print('ensemble size:', len(member_folders))
+        custom_print('seed:', random_seed)
 
         dev_file = os.path.join(src_data_folder, 'dev.json')
         dev_data = read_data(dev_file)
         custom_print('Dev data size:', len(dev_data))
-        torch.cuda.manual_seed(random_seed)
-        dev_preds = predict(dev_data, best_model, model_name)
-        dev_preds = np.array(dev_preds)
-
-        file_name = 'test'
-        test_input_file = os.path.join(src_data_folder, file_name + '.json')
-        test_data = read_data(test_input_file)
-        out_file_name = os.path.join(trg_data_folder, file_name + '-output.json')
-
+        test_file = os.path.join(src_data_folder, 'test.json')
+        test_data = read_data(test_file)
         custom_print('Test data size:', len(test_data))
-        torch.cuda.manual_seed(random_seed)
-        test_preds = predict(test_data, best_model, model_name)
-        test_preds = np.array(test_preds)
 
-        for en_cnt in range(1, 5):
-            trg_data_folder = sys.argv[5 + en_cnt]
-            custom_print('prediction with model: ', en_cnt + 1)
-            custom_print(trg_data_folder)
+        dev_preds = np.zeros((len(dev_data), len(relation_cls_label_map)), dtype=np.float32)
+        test_preds = np.zeros((len(test_data), len(relation_cls_label_map)), dtype=np.float32)
+        for group_folders in get_vocab_groups(member_folders):
+            run_folders = list()
+            for member_folder in group_folders:
+                member_dev_preds = load_pred_cache(get_pred_cache_file(member_folder, dev_file, model_name))
+                member_test_preds = load_pred_cache(get_pred_cache_file(member_folder, test_file, model_name))
+                if member_dev_preds is None or member_test_preds is None:
+                    run_folders.append(member_folder)
+                else:
+                    dev_preds += member_dev_preds
+                    test_preds += member_test_preds
+            if len(run_folders) == 0:
+                continue
 
             custom_print("loading word vectors......")
-            vocab_file_name = os.path.join(trg_data_folder, 'vocab.pkl')
-            word_vocab = load_vocab(vocab_file_name)
-
+            word_vocab = load_vocab(os.path.join(run_folders[0], 'vocab.pkl'))
             word_embed_matrix = np.zeros((len(word_vocab), word_embed_dim), dtype=np.float32)
             custom_print('vocab size:', len(word_vocab))
-
-            custom_print('seed:', random_seed)
-            model_file = os.path.join(trg_data_folder, 'model.h5py')
-
-            best_model = get_model(model_name)
-            custom_print(best_model)
-            if torch.cuda.is_available():
-                best_model.cuda()
-            best_model.load_state_dict(torch.load(model_file))
-
-            # prediction on dev data
-
-            dev_file = os.path.join(src_data_folder, 'dev.json')
-            dev_data = read_data(dev_file)
-            custom_print('Dev data size:', len(dev_data))
-            torch.cuda.manual_seed(random_seed)
-            dev_preds1 = np.array(predict(dev_data, best_model, model_name))
-            dev_preds += dev_preds1
-
-            file_name = 'test'
-            test_input_file = os.path.join(src_data_folder, file_name + '.json')
-            test_data = read_data(test_input_file)
-            out_file_name = os.path.join(trg_data_folder, file_name + '-output.json')
-
-            custom_print('Test data size:', len(test_data))
-            torch.cuda.manual_seed(random_seed)
-            test_preds1 = np.array(predict(test_data, best_model, model_name))
-            test_preds += test_preds1
-
-        dev_preds /= 5
-        test_preds /= 5
+            index_data(dev_data)
+            index_data(test_data)
+
+            best_models = list()
+            for member_folder in run_folders:
+                custom_print('loading model:', member_folder)
+                best_models.append(load_model(member_folder, model_name))
+
+            for cur_data, cur_file, cur_preds in [(dev_data, dev_file, dev_preds),
+                                                  (test_data, test_file, test_preds)]:
+                if not use_pred_cache:
+                    cur_preds += predict_ensemble(cur_data, best_models, model_name)
+                    continue
+                member_preds = [np.zeros(cur_preds.shape, dtype=np.float32) for _ in run_folders]
+                predict_ensemble(cur_data, best_models, model_name, member_preds)
+                for member_folder, member_cur_preds in zip(run_folders, member_preds):
+                    cache_file = get_pred_cache_file(member_folder, cur_file, model_name)
+                    cur_preds += save_pred_cache(cache_file, member_cur_preds)
+
+        dev_preds /= len(member_folders)
+        test_preds /= len(member_folders)
 
         custom_print('\nEnsemble Dev Results')
         pred_pos, gt_pos, correct_pos = get_F1(dev_data, dev_preds)